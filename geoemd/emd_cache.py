@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class EMDCache:
+    """
+    LRU cache for the group centroids and cost matrices of the EMD evaluation,
+    keyed by a hash of the station set and the hierarchy. Values are arrays or
+    dictionaries of arrays and are optionally persisted to disk (.npy / .npz)
+    """
+
+    def __init__(self, max_size=16, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(stations, hierarchy=None):
+        """Hash of the station ids and coordinates and of the hierarchy"""
+        hasher = hashlib.sha1()
+        hasher.update(np.asarray(stations.index.astype(str)).astype("U").data)
+        hasher.update(
+            np.ascontiguousarray(stations[["x", "y"]].values, dtype=float).data
+        )
+        if hierarchy is not None:
+            hasher.update(
+                json.dumps(hierarchy, sort_keys=True, default=str).encode()
+            )
+        return hasher.hexdigest()
+
+    def get(self, key, name, compute_fn):
+        """Return the cached value or compute (and store) it with compute_fn"""
+        entry_key = (key, name)
+        with self._lock:
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                return self._entries[entry_key]
+        value = self._load(key, name)
+        if value is None:
+            value = compute_fn()
+            self._save(key, name, value)
+        # cached arrays are shared between callers and must not be modified
+        for arr in value.values() if isinstance(value, dict) else [value]:
+            arr.flags.writeable = False
+        with self._lock:
+            self._entries[entry_key] = value
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _path(self, key, name):
+        return os.path.join(self.cache_dir, f"{key}_{name}")
+
+    def _load(self, key, name):
+        if self.cache_dir is None:
+            return None
+        path = self._path(key, name)
+        if os.path.exists(path + ".npy"):
+            return np.load(path + ".npy")
+        if os.path.exists(path + ".npz"):
+            with np.load(path + ".npz") as stored:
+                return {field: stored[field] for field in stored.files}
+        return None
+
+    def _save(self, key, name, value):
+        if self.cache_dir is None:
+            return
+        if isinstance(value, dict):
+            np.savez(self._path(key, name) + ".npz", **value)
+        else:
+            np.save(self._path(key, name) + ".npy", value)
@@ -1,4 +1,5 @@
 from typing import Any
+from concurrent.futures import ThreadPoolExecutor
 import wasserstein
 import pandas as pd
 import numpy as np
@@ -6,6 +7,16 @@ from scipy.spatial.distance import cdist
 from scipy.special import softmax
 
 from geoemd.hierarchy.hierarchy_utils import hierarchy_to_df
+from geoemd.hierarchy.full_station_hierarchy import FullStationHierarchy
+from geoemd.emd_solvers import (
+    exact_emd,
+    sparse_emd,
+    TreeMetric,
+    sliced_emd,
+    sinkhorn_emd,
+    grid_sinkhorn_emd,
+    approximation_report,
+)
 
 """
 MODES:
@@ -17,58 +28,396 @@ take the center coordinates of the group and use the
 distances between group centers and stations as cdist
 group_to_group: We just compute the EMD error in terms of
 rebalancing between the clusters
+
+SOLVERS:
+exact: network simplex on the dense distance matrix
+sparse: min-cost flow on a k-nearest-neighbour graph of the locations
+(solver_kwargs k or radius), upper bound of the exact EMD
+tree: closed-form EMD on the tree metric of a station hierarchy (solver_kwargs
+hierarchy, default: agglomerative FullStationHierarchy of the stations),
+only for distributions over stations
+sliced: sliced Wasserstein distance, averaged over 1D projections of the
+locations (solver_kwargs nr_projections), for fast screening / ranking
+sinkhorn: transport cost of the entropic plan, batched Sinkhorn matrix scaling
+with epsilon scaling (solver_kwargs blur, scaling, tol, max_iter), the number
+of iterations per row is returned by evaluate(..., return_iters=True)
+grid: convolutional Sinkhorn on a regular grid of the projected coordinates
+(solver_kwargs cell_size or max_cells, blur, ...), square root of the
+debiased divergence for the squared distance (W2), for large station sets
+
+The wrapper does not modify its state or the inputs during the evaluation, so
+one instance can be shared between threads.
 """
 
+MODES = ["station_to_station", "group_to_station", "group_to_group"]
+# solvers that only support some of the modes
+SOLVER_MODES = {"tree": ["station_to_station"]}
+SAMPLE_KEYS = ["val_sample_ind", "steps_ahead"]
 
-class EMDWrapper:
-    def __init__(self, stations, gt_reference):
-        self.gt_reference = gt_reference.set_index(
-            ["val_sample_ind", "steps_ahead"]
-        ).rename({"group": "station"}, axis=1)
-        self.stations = stations
-        assert self.stations.index.name == "station_id"
-        self.stations.sort_index(inplace=True)
-        # default dist matrix: between stations
-        self.dist_matrix = cdist(
-            self.stations[["x", "y"]], self.stations[["x", "y"]]
+
+def to_dense(df, value_col, location_col="station"):
+    """
+    Convert a long dataframe with one row per (val_sample_ind, steps_ahead,
+    location) into a dense array of shape (samples, steps, locations)
+    Returns: the sorted sample and step indices, the sorted locations and the
+    dense array (NaN where no row exists)
+    """
+    sample_codes, samples = pd.factorize(df["val_sample_ind"], sort=True)
+    step_codes, steps = pd.factorize(df["steps_ahead"], sort=True)
+    location_codes, locations = pd.factorize(df[location_col], sort=True)
+    if np.any(location_codes < 0):
+        raise ValueError(f"Missing values in column {location_col}")
+    dense = np.full((len(samples), len(steps), len(locations)), np.nan)
+    dense[sample_codes, step_codes, location_codes] = df[value_col].values
+    return samples, steps, locations, dense
+
+
+def iter_block_batches(csv_path, chunksize=100000):
+    """
+    Read a result csv in chunks and yield the complete (val_sample_ind,
+    steps_ahead) blocks of each chunk as a list of dataframes. The rows of one
+    block must be contiguous, as in the files written by
+    train_bikes.test_models
+    """
+    remainder = None
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        if remainder is not None:
+            chunk = pd.concat([remainder, chunk], ignore_index=True)
+        keys = chunk[SAMPLE_KEYS].values
+        block_starts = np.concatenate(
+            [[0], np.where(np.any(keys[1:] != keys[:-1], axis=1))[0] + 1]
         )
+        # the last block may continue in the next chunk
+        yield [
+            chunk.iloc[start:stop]
+            for start, stop in zip(block_starts[:-1], block_starts[1:])
+        ]
+        remainder = chunk.iloc[block_starts[-1] :]
+    if remainder is not None and len(remainder) > 0:
+        yield [remainder]
+
+
+class EMDWrapper:
+    def __init__(
+        self,
+        stations,
+        gt_reference,
+        solver="exact",
+        batch_size=1024,
+        n_workers=1,
+        cache=None,
+        **solver_kwargs,
+    ):
+        if solver not in [
+            "exact",
+            "sparse",
+            "tree",
+            "sliced",
+            "sinkhorn",
+            "grid",
+        ]:
+            raise ValueError("Invalid solver")
+        if solver_kwargs.get("per_location", False):
+            # the wrapper returns one EMD per row
+            raise ValueError(
+                "per_location is not supported by the wrapper, use "
+                "grid_sinkhorn_emd directly"
+            )
+        assert stations.index.name == "station_id"
+        self.stations = stations.sort_index()
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.solver = solver
+        self.solver_kwargs = solver_kwargs
+        # optional EMDCache for centroids and cost matrices
+        self.cache = cache
+        self.station_coords = self.stations[["x", "y"]].values
+        # align the gt once: (samples, steps, stations). The gt can also be
+        # None and passed to prepare instead (e.g. when streaming)
+        self.gt_reference, self.gt_dense = None, None
+        if gt_reference is not None:
+            self.gt_reference = gt_reference.set_index(SAMPLE_KEYS).rename(
+                {"group": "station"}, axis=1
+            )
+            self.gt_dense = to_dense(gt_reference, "gt", location_col="group")
+        # default dist matrix: between stations (not needed by sparse solver)
+        if self.solver in ["exact", "sinkhorn"]:
+            self.dist_matrix = self.get_station_dist_matrix()
+        elif self.solver == "tree":
+            hier = self.solver_kwargs.get("hierarchy")
+            if hier is None:
+                station_hierarchy = FullStationHierarchy()
+                station_hierarchy.init_from_station_locations(self.stations)
+                hier = station_hierarchy.hier
+            self.tree_metric = TreeMetric(hier, self.stations)
 
     def __call__(self, res, res_hierarchy, mode="station_to_station"):
-        if mode == "station_to_station":
-            return self.emd_station_to_station(res, res_hierarchy)
-        elif mode == "group_to_group":
-            return self.emd_group_to_group(res, res_hierarchy)
-        elif mode == "group_to_station":
-            return self.emd_group_to_station(res, res_hierarchy)
-        else:
+        if mode not in MODES:
             raise ValueError("Invalid mode")
+        return self.evaluate(self.prepare(res, res_hierarchy), mode)
+
+    def evaluate_all(self, res, res_hierarchy, modes=MODES, n_threads=3):
+        """
+        Compute the EMD for several modes at once. The alignment of res with
+        the hierarchy and the gt is only done once, and the modes are
+        evaluated concurrently in a thread pool
+        Returns: dictionary with the list of EMD values per mode
+        """
+        prepared = self.prepare(res, res_hierarchy)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = {
+                mode: executor.submit(self.evaluate, prepared, mode)
+                for mode in modes
+            }
+            return {mode: future.result() for mode, future in futures.items()}
+
+    def iter_emd(
+        self,
+        res_path: str,
+        res_hierarchy: dict = None,
+        mode: str = "station_to_station",
+        gt_path: str = None,
+        chunksize: int = 100000,
+    ):
+        """
+        Evaluate a result csv chunk by chunk, with bounded memory
+        gt_path: csv with the gt per station (same block order as res_path).
+            If None, the gt in res_path is used if there is no hierarchy,
+            otherwise the gt_reference of the wrapper (if any)
+        Yields: ((val_sample_ind, steps_ahead), emd) per block, in file order
+        """
+        gt_blocks = None
+        if gt_path is not None:
+            gt_blocks = (
+                block
+                for batch in iter_block_batches(gt_path, chunksize)
+                for block in batch
+            )
+        for res_blocks in iter_block_batches(res_path, chunksize):
+            if len(res_blocks) == 0:
+                continue
+            res_chunk = pd.concat(res_blocks)
+            if gt_blocks is None:
+                # gt in the res is only per station if there are no groups
+                gt_chunk = res_chunk if res_hierarchy is None else None
+            else:
+                gt_chunk = pd.concat([next(gt_blocks) for _ in res_blocks])
+                if not np.array_equal(
+                    gt_chunk[SAMPLE_KEYS].drop_duplicates().values,
+                    res_chunk[SAMPLE_KEYS].drop_duplicates().values,
+                ):
+                    raise ValueError("Blocks of gt and res are not aligned")
+            # without gt_chunk, the gt_reference of the wrapper is used
+            prepared = self.prepare(res_chunk, res_hierarchy, gt_chunk)
+            emd = pd.Series(
+                self.evaluate(prepared, mode), index=prepared["keys"]
+            )
+            for block in res_blocks:
+                key = tuple(block[SAMPLE_KEYS].iloc[0])
+                yield key, emd.loc[key]
 
     def emd_station_to_station(
         self, res: pd.DataFrame, res_hierarchy: dict = None
     ) -> list:
+        return self(res, res_hierarchy, mode="station_to_station")
+
+    def emd_group_to_station(
+        self, res: pd.DataFrame, res_hierarchy: dict
+    ) -> list:
+        return self(res, res_hierarchy, mode="group_to_station")
+
+    def emd_group_to_group(self, res: pd.DataFrame, res_hierarchy: dict):
+        return self(res, res_hierarchy, mode="group_to_group")
+
+    def prepare(
+        self,
+        res: pd.DataFrame,
+        res_hierarchy: dict = None,
+        gt_reference: pd.DataFrame = None,
+    ) -> dict:
+        """
+        Align the predictions of one result dataframe with the gt and the
+        hierarchy. The returned arrays are shared by all modes
+        gt_reference: gt per station for the samples in res, default: the
+        gt_reference of the wrapper
+        """
+        samples, steps, groups, pred_groups = to_dense(
+            res, "pred", location_col="group"
+        )
+        # flatten to (samples * steps, groups), in the order of groupby
+        pred_groups = pred_groups.reshape(-1, len(groups))
+        # skip (sample, step) pairs that do not occur in the predictions
+        occurring = ~np.all(np.isnan(pred_groups), axis=1)
+        gt_dense = (
+            self.gt_dense
+            if gt_reference is None
+            else to_dense(gt_reference, "gt", location_col="group")
+        )
+        keys = pd.MultiIndex.from_product([samples, steps], names=SAMPLE_KEYS)
+        prepared = {
+            "keys": keys[occurring],
+            "res_hierarchy": res_hierarchy,
+            "pred_groups": pred_groups[occurring],
+            "gt_stations": None,
+        }
+        if gt_dense is not None:
+            prepared["gt_stations"] = self.align_gt(samples, steps, gt_dense)[
+                occurring
+            ]
         if res_hierarchy is None:
-            # only possibility is station-to-station mode,
-            # because there are no groups
-            res_per_station = res.copy()
-            res_per_station["pred_emd"] = res_per_station["pred"]
-            res_per_station["station"] = res_per_station["group"]
+            # no groups: the predictions are already per station
+            prepared["pred_stations"] = prepared["pred_groups"]
         else:
-            station_group_df = hierarchy_to_df(res_hierarchy)
-            # merge them in order to get predictions per station
-            res_per_station = pd.merge(
-                station_group_df,
-                res,
-                how="right",
-                left_on="group",
-                right_on="group",
+            # gt per group is in the res
+            gt_groups = to_dense(res, "gt", location_col="group")[-1]
+            prepared["gt_groups"] = gt_groups.reshape(-1, len(groups))[
+                occurring
+            ]
+            # split group predictions over their stations in equal parts
+            prepared["pred_stations"] = prepared[
+                "pred_groups"
+            ] @ self.group_to_station_matrix(groups, res_hierarchy)
+            coords_per_group = self.get_coords_per_group(res_hierarchy)
+            if not coords_per_group.index.equals(pd.Index(groups.astype(str))):
+                raise ValueError(
+                    "Groups in res and res_hierarchy do not match"
+                )
+            prepared["group_coords"] = coords_per_group[["x", "y"]].values
+        for key in ["pred_stations", "gt_stations", "gt_groups"]:
+            if prepared.get(key) is not None and np.any(
+                np.isnan(prepared[key])
+            ):
+                raise ValueError("Predictions or gt are missing for some rows")
+        return prepared
+
+    def evaluate(
+        self,
+        prepared: dict,
+        mode: str,
+        solver: str = None,
+        return_iters: bool = False,
+    ) -> list:
+        """
+        Compute the EMD of prepared predictions in one mode
+        return_iters: also return the number of Sinkhorn iterations per row
+            (None for the solvers that do not iterate). They are returned
+            instead of stored, such that the wrapper stays thread-safe
+        """
+        res_hierarchy = prepared["res_hierarchy"]
+        solver = self.solver if solver is None else solver
+        # without groups, all modes are station-to-station
+        if res_hierarchy is not None and mode not in SOLVER_MODES.get(
+            solver, MODES
+        ):
+            raise ValueError(f"Solver {solver} does not support mode {mode}")
+        if prepared["gt_stations"] is None and (
+            mode != "group_to_group" or res_hierarchy is None
+        ):
+            raise ValueError(f"Mode {mode} requires the gt per station")
+        if mode == "station_to_station" or res_hierarchy is None:
+            # without groups, all modes are station-to-station
+            emd, n_iters = self.solve(
+                prepared["pred_stations"],
+                prepared["gt_stations"],
+                self.station_coords,
+                dist_matrix_fn=self.get_station_dist_matrix,
+                solver=solver,
+                return_iters=True,
             )
-            res_per_station["pred_emd"] = (
-                res_per_station["pred"] / res_per_station["nr_stations"]
+        elif mode == "group_to_station":
+            # distance matrix is between groups (pred) and stations (gt)
+            group_coords = prepared["group_coords"]
+            emd, n_iters = self.solve(
+                prepared["pred_groups"],
+                prepared["gt_stations"],
+                group_coords,
+                self.station_coords,
+                dist_matrix_fn=lambda: self.cached(
+                    res_hierarchy,
+                    "dist_group_to_station",
+                    lambda: cdist(group_coords, self.station_coords),
+                ),
+                solver=solver,
+                return_iters=True,
+            )
+        elif mode == "group_to_group":
+            # distance matrix is between groups, the gt is in the res
+            group_coords = prepared["group_coords"]
+            emd, n_iters = self.solve(
+                prepared["pred_groups"],
+                prepared["gt_groups"],
+                group_coords,
+                dist_matrix_fn=lambda: self.cached(
+                    res_hierarchy,
+                    "dist_group_to_group",
+                    lambda: cdist(group_coords, group_coords),
+                ),
+                solver=solver,
+                return_iters=True,
             )
-        # compute EMD
-        return self.compute_emd(res_per_station)
+        else:
+            raise ValueError("Invalid mode")
+        if return_iters:
+            return emd.tolist(), None if n_iters is None else n_iters.tolist()
+        return emd.tolist()
+
+    def align_gt(
+        self, samples: pd.Index, steps: pd.Index, gt_dense: tuple = None
+    ) -> np.ndarray:
+        """gt per station for the given samples and steps, flattened"""
+        if gt_dense is None:
+            gt_dense = self.gt_dense
+        gt_samples, gt_steps, _, gt_values = gt_dense
+        sample_inds = gt_samples.get_indexer(samples)
+        step_inds = gt_steps.get_indexer(steps)
+        if np.any(sample_inds < 0) or np.any(step_inds < 0):
+            raise ValueError("gt_reference misses some samples or steps")
+        gt_values = gt_values[np.ix_(sample_inds, step_inds)]
+        return gt_values.reshape(-1, gt_values.shape[-1])
+
+    def group_to_station_matrix(
+        self, groups: pd.Index, res_hierarchy: dict
+    ) -> np.ndarray:
+        """Matrix (groups x stations) with 1 / nr_stations for each member"""
+        station_group_df = hierarchy_to_df(res_hierarchy)
+        group_inds = groups.get_indexer(station_group_df["group"])
+        station_inds = self.stations.index.get_indexer(
+            station_group_df["station"]
+        )
+        if np.any(station_inds < 0):
+            raise ValueError("Hierarchy contains unknown stations")
+        known = group_inds >= 0
+        matrix = np.zeros((len(groups), len(self.stations)))
+        matrix[group_inds[known], station_inds[known]] = (
+            1 / station_group_df["nr_stations"].values[known]
+        )
+        return matrix
+
+    def cached(self, res_hierarchy: dict, name: str, compute_fn):
+        """Get a value for these stations and hierarchy from the cache"""
+        if self.cache is None:
+            return compute_fn()
+        key = self.cache.make_key(self.stations, res_hierarchy)
+        return self.cache.get(key, name, compute_fn)
+
+    def get_station_dist_matrix(self) -> np.ndarray:
+        if hasattr(self, "dist_matrix"):
+            return self.dist_matrix
+        return self.cached(
+            None,
+            "dist_station_to_station",
+            lambda: cdist(self.station_coords, self.station_coords),
+        )
+
+    def get_coords_per_group(self, res_hierarchy: dict) -> pd.DataFrame:
+        coords_per_group = self.cached(
+            res_hierarchy,
+            "coords_per_group",
+            lambda: self.compute_coords_per_group(res_hierarchy),
+        )
+        return pd.DataFrame(coords_per_group).set_index("group")
 
-    def get_coords_per_group(self, res_hierarchy: dict) -> list:
+    def compute_coords_per_group(self, res_hierarchy: dict) -> dict:
         # get groups
         station_group_df = hierarchy_to_df(res_hierarchy)
         coords_per_group = self.stations.merge(
@@ -78,41 +427,124 @@ class EMDWrapper:
             {"x": "mean", "y": "mean"}
         )
         coords_per_group.sort_index(inplace=True)
-        return coords_per_group
+        return {
+            "group": coords_per_group.index.values.astype(str),
+            "x": coords_per_group["x"].values,
+            "y": coords_per_group["y"].values,
+        }
 
-    def emd_group_to_station(
-        self, res: pd.DataFrame, res_hierarchy: dict
-    ) -> list:
-        if res_hierarchy is None:
-            return self.emd_station_to_station(res, res_hierarchy)
-        coords_per_group = self.get_coords_per_group(res_hierarchy)
-        # distance matrix is between groups (pred) and stations (gt)
-        self.dist_matrix = cdist(
-            coords_per_group[["x", "y"]], self.stations[["x", "y"]]
+    def compute_emd(self, res_per_station: pd.DataFrame) -> list:
+        """EMD of a dataframe with predictions (pred_emd) per station"""
+        samples, steps, _, pred_dense = to_dense(res_per_station, "pred_emd")
+        pred_flat = pred_dense.reshape(-1, pred_dense.shape[-1])
+        occurring = ~np.all(np.isnan(pred_flat), axis=1)
+        gt_flat = self.align_gt(samples, steps)[occurring]
+        if np.any(np.isnan(pred_flat[occurring])) or np.any(np.isnan(gt_flat)):
+            raise ValueError("Predictions or gt are missing for some stations")
+        emd = self.solve(
+            pred_flat[occurring],
+            gt_flat,
+            self.station_coords,
+            dist_matrix_fn=self.get_station_dist_matrix,
         )
-        # predictions are just the per-group predictions
-        res["pred_emd"] = res["pred"].copy()
-        res["station"] = res["group"]
-        # compute EMD
-        return self.compute_emd(res)
+        return emd.tolist()
 
-    def emd_group_to_group(self, res: pd.DataFrame, res_hierarchy: dict):
-        if res_hierarchy is None:
-            return self.emd_station_to_station(res, res_hierarchy)
-        coords_per_group = self.get_coords_per_group(res_hierarchy)
-        # distance matrix is between groups
-        self.dist_matrix = cdist(
-            coords_per_group[["x", "y"]], coords_per_group[["x", "y"]]
-        )
-        # the prediction is just the per group prediction
-        res["pred_emd"] = res["pred"]
-        res["station"] = res["group"]
-        # the gt is in the res
-        self.gt_reference = res.set_index(["val_sample_ind", "steps_ahead"])
+    def solve(
+        self,
+        pred,
+        gt,
+        pred_coords,
+        gt_coords=None,
+        dist_matrix_fn=None,
+        solver=None,
+        return_iters=False,
+    ):
+        """
+        Compute the EMD per row of the (sample, location) arrays
+        pred_coords, gt_coords: locations of the predictions and of the gt,
+            gt_coords=None means that the gt is on the same locations as pred
+        dist_matrix_fn: returns the distance matrix for the exact solver
+        solver: overwrites the solver of the wrapper
+        return_iters: also return the number of Sinkhorn iterations per row
+            (None for the solvers that do not iterate)
+        """
+        solver = self.solver if solver is None else solver
+        n_iters = None
+        if solver == "exact":
+            emd = exact_emd(
+                pred,
+                gt,
+                dist_matrix_fn(),
+                batch_size=self.batch_size,
+                n_workers=self.n_workers,
+            )
+        elif solver == "sparse":
+            emd = sparse_emd(
+                pred,
+                gt,
+                pred_coords,
+                gt_coords,
+                batch_size=self.batch_size,
+                **self.solver_kwargs,
+            )
+        elif solver == "tree":
+            if pred_coords is not self.station_coords or gt_coords is not None:
+                raise ValueError(
+                    "Tree solver only supports the station_to_station mode"
+                )
+            emd = self.tree_metric(pred, gt, batch_size=self.batch_size)
+        elif solver == "sliced":
+            emd = sliced_emd(
+                pred,
+                gt,
+                pred_coords,
+                gt_coords,
+                batch_size=self.batch_size,
+                **self.solver_kwargs,
+            )
+        elif solver == "sinkhorn":
+            # sinkhorn_emd warns if some samples have not converged
+            emd, n_iters = sinkhorn_emd(
+                pred,
+                gt,
+                dist_matrix_fn(),
+                batch_size=self.batch_size,
+                **self.solver_kwargs,
+            )
+        elif solver == "grid":
+            emd = grid_sinkhorn_emd(
+                pred,
+                gt,
+                pred_coords,
+                gt_coords,
+                batch_size=self.batch_size,
+                **self.solver_kwargs,
+            )
+        if return_iters:
+            return emd, n_iters
+        return emd
 
-        return self.compute_emd(res)
+    def compare_to_exact(
+        self, res, res_hierarchy=None, mode="station_to_station", nr_samples=10
+    ):
+        """
+        Report the deviation of the solver from the exact EMD on the first
+        nr_samples validation samples
+        """
+        samples = np.sort(res["val_sample_ind"].unique())[:nr_samples]
+        prepared = self.prepare(
+            res[res["val_sample_ind"].isin(samples)], res_hierarchy
+        )
+        approx = self.evaluate(prepared, mode)
+        exact = self.evaluate(prepared, mode, solver="exact")
+        return approximation_report(approx, exact)
 
-    def compute_emd(self, res_per_station: pd.DataFrame) -> list:
+    def compute_emd_groupwise(self, res_per_station: pd.DataFrame) -> list:
+        """
+        Deprecated: Per-group implementation of compute_emd, only kept as a
+        reference for testing and benchmarking
+        """
+        dist_matrix = self.get_station_dist_matrix()
         # compute emd
         emd = []
         for (val_sample, steps_ahead), sample_df in res_per_station.groupby(
@@ -130,7 +562,7 @@ class EMDWrapper:
             emd_distance = was(
                 pred_vals,
                 gt_vals,
-                self.dist_matrix,
+                dist_matrix,
             )
             emd.append(emd_distance)
 
@@ -0,0 +1,508 @@
+import warnings
+import numpy as np
+import torch
+import wasserstein
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from scipy.optimize import linprog
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from scipy.special import softmax
+from scipy.stats import pearsonr, spearmanr
+
+from geoemd.loss.sinkhorn_solver import (
+    debiased_divergence,
+    epsilon_schedule,
+    kernel_sinkhorn,
+    log_sinkhorn,
+    transport_plan,
+)
+from geoemd.loss.convolutional_sinkhorn import StationGrid, grid_sinkhorn
+from geoemd.hierarchy.tree_index import TreeIndex
+
+# arrays that are shared with the worker processes (set by _init_worker)
+_shared_arrays = {}
+
+
+def exact_emd(pred, gt, dist_matrix, batch_size=1024, n_workers=1):
+    """
+    Exact EMD between each row of pred and gt with the network simplex solver
+    pred: array of shape (nr_samples, nr_pred_locations), unnormalized
+    gt: array of shape (nr_samples, nr_gt_locations), unnormalized
+    dist_matrix: array of shape (nr_pred_locations, nr_gt_locations)
+    n_workers: if larger than 1, the samples are distributed over a pool of
+        processes that access the arrays via shared memory
+    Returns: array of shape (nr_samples) with the EMD per sample
+    """
+    assert pred.shape[0] == gt.shape[0]
+    assert dist_matrix.shape == (pred.shape[1], gt.shape[1])
+    dist_matrix = np.ascontiguousarray(dist_matrix, dtype=np.float64)
+    if n_workers > 1:
+        return _parallel_exact_emd(
+            pred, gt, dist_matrix, batch_size, n_workers
+        )
+    # one solver object is reused for all samples
+    was = wasserstein.EMD()
+    emd = np.zeros(len(pred))
+    for start in range(0, len(pred), batch_size):
+        # normalize the whole batch at once
+        pred_vals = softmax(pred[start : start + batch_size], axis=-1)
+        gt_vals = softmax(gt[start : start + batch_size], axis=-1)
+        for i in range(len(pred_vals)):
+            emd[start + i] = was(pred_vals[i], gt_vals[i], dist_matrix)
+    return emd
+
+
+def _to_shared_memory(arr):
+    """Copy an array into a new shared memory block"""
+    arr = np.ascontiguousarray(arr, dtype=np.float64)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+    return shm, (shm.name, arr.shape)
+
+
+def _init_worker(shared_specs):
+    """Attach the shared memory blocks once per worker process"""
+    for key, (name, shape) in shared_specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        # keep a reference to the block, otherwise the buffer is released
+        _shared_arrays[key] = (
+            shm,
+            np.ndarray(shape, dtype=np.float64, buffer=shm.buf),
+        )
+
+
+def _solve_range(start, stop):
+    pred = _shared_arrays["pred"][1][start:stop]
+    gt = _shared_arrays["gt"][1][start:stop]
+    dist_matrix = _shared_arrays["dist_matrix"][1]
+    return exact_emd(pred, gt, dist_matrix, batch_size=stop - start)
+
+
+def _parallel_exact_emd(pred, gt, dist_matrix, batch_size, n_workers):
+    shared_blocks, shared_specs = [], {}
+    try:
+        for key, arr in zip(
+            ["pred", "gt", "dist_matrix"], [pred, gt, dist_matrix]
+        ):
+            shm, shared_specs[key] = _to_shared_memory(arr)
+            shared_blocks.append(shm)
+        # the tasks only consist of the sample ranges (several per worker)
+        batch_size = max(1, min(batch_size, len(pred) // (4 * n_workers)))
+        starts = list(range(0, len(pred), batch_size))
+        stops = [min(start + batch_size, len(pred)) for start in starts]
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_worker,
+            initargs=(shared_specs,),
+        ) as executor:
+            # map returns the results in the order of the tasks
+            emd_per_range = list(executor.map(_solve_range, starts, stops))
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+    if len(emd_per_range) == 0:
+        return np.zeros(0)
+    return np.concatenate(emd_per_range)
+
+
+def sparse_transport_graph(coords, k=8, radius=None):
+    """
+    Sparse graph over the locations with edges to the k nearest neighbours
+    (or to all neighbours within the radius). If the graph is not connected,
+    the components are joined by their shortest connecting edges.
+    Returns: arrays of edge sources, edge targets and edge lengths
+    (each edge is listed once)
+    """
+    nr_nodes = len(coords)
+    tree = cKDTree(coords)
+    if radius is None:
+        k = min(k, nr_nodes - 1)
+        lengths, targets = tree.query(coords, k=k + 1)
+        # first neighbour is the node itself
+        sources = np.repeat(np.arange(nr_nodes), k)
+        targets, lengths = targets[:, 1:].flatten(), lengths[:, 1:].flatten()
+    else:
+        pairs = tree.query_pairs(radius, output_type="ndarray")
+        sources, targets = pairs[:, 0], pairs[:, 1]
+        lengths = np.linalg.norm(coords[sources] - coords[targets], axis=1)
+
+    # add long edges until the graph is connected
+    while True:
+        graph = coo_matrix(
+            (np.ones(len(sources)), (sources, targets)),
+            shape=(nr_nodes, nr_nodes),
+        )
+        nr_components, labels = connected_components(graph, directed=False)
+        if nr_components == 1:
+            break
+        new_edges = []
+        for component in range(nr_components):
+            inside = np.where(labels == component)[0]
+            outside = np.where(labels != component)[0]
+            dist, nearest = cKDTree(coords[outside]).query(coords[inside])
+            best = np.argmin(dist)
+            new_edges.append(
+                (inside[best], outside[nearest[best]], dist[best])
+            )
+        new_edges = np.array(new_edges)
+        sources = np.concatenate([sources, new_edges[:, 0].astype(int)])
+        targets = np.concatenate([targets, new_edges[:, 1].astype(int)])
+        lengths = np.concatenate([lengths, new_edges[:, 2]])
+    return sources, targets, lengths
+
+
+def sparse_emd(
+    pred, gt, pred_coords, gt_coords=None, k=8, radius=None, batch_size=1024
+):
+    """
+    EMD solved as min-cost flow on a sparse k-nearest-neighbour graph. The
+    distances are shortest paths in the graph, so the result is an upper
+    bound of the exact EMD.
+    pred: array of shape (nr_samples, nr_pred_locations), unnormalized
+    gt: array of shape (nr_samples, nr_gt_locations), unnormalized
+    pred_coords, gt_coords: coordinates of the locations, gt_coords=None means
+        that pred and gt are defined on the same locations
+    Returns: array of shape (nr_samples) with the EMD per sample
+    """
+    if gt_coords is None:
+        coords = np.asarray(pred_coords, dtype=np.float64)
+    else:
+        # mass of pred and gt sits on separate nodes of a joint graph
+        coords = np.concatenate([pred_coords, gt_coords]).astype(np.float64)
+    nr_nodes = len(coords)
+    sources, targets, lengths = sparse_transport_graph(coords, k, radius)
+
+    # flow in both directions along each edge
+    nr_edges = len(sources)
+    edge_from = np.concatenate([sources, targets])
+    edge_to = np.concatenate([targets, sources])
+    cost = np.concatenate([lengths, lengths])
+    # node-edge incidence matrix: outflow - inflow = supply
+    incidence = coo_matrix(
+        (
+            np.concatenate([np.ones(2 * nr_edges), -np.ones(2 * nr_edges)]),
+            (
+                np.concatenate([edge_from, edge_to]),
+                np.tile(np.arange(2 * nr_edges), 2),
+            ),
+        ),
+        shape=(nr_nodes, 2 * nr_edges),
+    ).tocsr()
+    # one flow constraint is redundant because the supply sums up to zero
+    incidence = incidence[:-1]
+
+    emd = np.zeros(len(pred))
+    for start in range(0, len(pred), batch_size):
+        pred_vals = softmax(pred[start : start + batch_size], axis=-1)
+        gt_vals = softmax(gt[start : start + batch_size], axis=-1)
+        if gt_coords is None:
+            supply = pred_vals - gt_vals
+        else:
+            supply = np.concatenate([pred_vals, -gt_vals], axis=1)
+        for i in range(len(supply)):
+            solution = linprog(
+                cost,
+                A_eq=incidence,
+                b_eq=supply[i, :-1],
+                bounds=(0, None),
+                method="highs",
+            )
+            if not solution.success:
+                raise RuntimeError(
+                    "Sparse min-cost flow failed: " + solution.message
+                )
+            emd[start + i] = solution.fun
+    return emd
+
+
+class TreeMetric:
+    """
+    Tree-Wasserstein distance: EMD on the tree metric of a hierarchy, i.e.
+    the sum over all edges of the edge length times the absolute difference
+    of the mass in the subtree below the edge. Computed in linear time and
+    vectorized over samples.
+    """
+
+    def __init__(self, hier, locations):
+        """
+        hier: dictionary mapping each group to its children (groups or
+            stations), e.g. FullStationHierarchy.hier, or a TreeIndex
+        locations: dataframe with the coordinates x and y of the stations
+            (leaves); its order defines the order of the columns of pred / gt
+        """
+        tree = (
+            hier if isinstance(hier, TreeIndex) else TreeIndex.from_hier(hier)
+        )
+        if np.sum(tree.parent < 0) != 1:
+            # join several trees by a common virtual root
+            hier = {
+                tree.names[node]: tree.names[tree.parent == node].tolist()
+                for node in np.where(~tree.is_leaf)[0]
+            }
+            hier["_root"] = tree.names[tree.parent < 0].tolist()
+            tree = TreeIndex.from_hier(hier)
+        station_names = np.asarray(locations.index).astype(str)
+        missing = np.setdiff1d(station_names, tree.names)
+        if len(missing) > 0:
+            raise ValueError(
+                f"Stations {set(missing)} are not in the hierarchy"
+            )
+        # sparse matrix (nodes x leaves) indicating the leaves of each subtree
+        subtree = tree.leaf_matrix(station_names)
+        centroids = (
+            subtree @ locations[["x", "y"]].values / tree.nr_leaves[:, None]
+        )
+
+        # one edge from every node (except the root) to its parent
+        has_parent = tree.parent >= 0
+        self.nodes = tree.names[has_parent]
+        self.subtree = subtree[has_parent]
+        self.edge_lengths = np.linalg.norm(
+            centroids[has_parent] - centroids[tree.parent[has_parent]], axis=1
+        )
+
+    def __call__(self, pred, gt, batch_size=1024):
+        """
+        pred, gt: arrays of shape (nr_samples, nr_stations), unnormalized
+        Returns: array of shape (nr_samples) with the tree EMD per sample
+        """
+        emd = np.zeros(len(pred))
+        for start in range(0, len(pred), batch_size):
+            pred_vals = softmax(pred[start : start + batch_size], axis=-1)
+            gt_vals = softmax(gt[start : start + batch_size], axis=-1)
+            diff = pred_vals - gt_vals
+            # mass imbalance in each subtree: (edges, samples)
+            imbalance = np.abs(self.subtree @ diff.T)
+            emd[start : start + batch_size] = self.edge_lengths @ imbalance
+        return emd
+
+
+def sliced_emd(
+    pred, gt, pred_coords, gt_coords=None, nr_projections=50, batch_size=1024
+):
+    """
+    Sliced Wasserstein distance: average 1D Wasserstein distance of the
+    distributions projected onto nr_projections evenly spaced directions
+    pred: array of shape (nr_samples, nr_pred_locations), unnormalized
+    gt: array of shape (nr_samples, nr_gt_locations), unnormalized
+    pred_coords, gt_coords: coordinates of the locations, gt_coords=None means
+        that pred and gt are defined on the same locations
+    Returns: array of shape (nr_samples) with the sliced EMD per sample
+    """
+    if gt_coords is None:
+        coords = np.asarray(pred_coords, dtype=np.float64)
+    else:
+        coords = np.concatenate([pred_coords, gt_coords]).astype(np.float64)
+    angles = np.arange(nr_projections) * np.pi / nr_projections
+    directions = np.stack([np.cos(angles), np.sin(angles)])
+    # the projected locations are the same for all samples -> sort once
+    projected = coords @ directions  # (locations, projections)
+    order = np.argsort(projected, axis=0)
+    gaps = np.diff(np.take_along_axis(projected, order, axis=0), axis=0)
+
+    emd = np.zeros(len(pred))
+    for start in range(0, len(pred), batch_size):
+        pred_vals = softmax(pred[start : start + batch_size], axis=-1)
+        gt_vals = softmax(gt[start : start + batch_size], axis=-1)
+        if gt_coords is None:
+            mass = pred_vals - gt_vals
+        else:
+            mass = np.concatenate([pred_vals, -gt_vals], axis=1)
+        for j in range(nr_projections):
+            # 1D Wasserstein: integral of the difference of the CDFs
+            cdf_diff = np.cumsum(mass[:, order[:, j]], axis=1)[:, :-1]
+            emd[start : start + batch_size] += np.abs(cdf_diff) @ gaps[:, j]
+    return emd / nr_projections
+
+
+def sinkhorn_emd(
+    pred,
+    gt,
+    dist_matrix,
+    blur=0.05,
+    scaling=0.5,
+    tol=1e-3,
+    max_iter=200,
+    batch_size=1024,
+):
+    """
+    Approximate EMD with batched Sinkhorn iterations (on CPU). The Gibbs
+    kernel of each temperature is built once and shared by all samples, such
+    that the iterations are float32 matrix products. Samples whose scalings
+    under- or overflow (small blur) are solved again with float64 kernels
+    and, if that is not enough, in the log domain
+    pred: array of shape (nr_samples, nr_pred_locations), unnormalized
+    gt: array of shape (nr_samples, nr_gt_locations), unnormalized
+    dist_matrix: array of shape (nr_pred_locations, nr_gt_locations)
+    blur: target temperature, relative to the maximum distance
+    scaling: factor of the epsilon schedule from the maximum distance to blur
+    tol: tolerance on the L1 error of the marginals, a warning is raised for
+        the samples that do not reach it within max_iter iterations
+    Returns: transport cost of the entropic plan and number of Sinkhorn
+    iterations, both arrays of shape (nr_samples)
+    """
+    max_cost = np.max(dist_matrix)
+    eps_list = epsilon_schedule(max_cost, blur * max_cost, scaling)
+    emd = np.full(len(pred), np.nan)
+    n_iters = np.zeros(len(pred), dtype=int)
+    rows = np.arange(len(pred))
+    with torch.no_grad():
+        for dtype in [torch.float32, torch.float64]:
+            emd[rows], n_iters[rows] = _kernel_sinkhorn_emd(
+                pred[rows],
+                gt[rows],
+                torch.from_numpy(np.asarray(dist_matrix)).to(dtype),
+                eps_list,
+                tol,
+                max_iter,
+                batch_size,
+            )
+            rows = rows[~np.isfinite(emd[rows])]
+            if len(rows) == 0:
+                break
+        if len(rows) > 0:
+            emd[rows], n_iters[rows] = _log_sinkhorn_emd(
+                pred[rows], gt[rows], dist_matrix, eps_list, tol, max_iter
+            )
+    # samples that have not converged are counted in all iterations
+    nr_not_converged = np.sum(n_iters >= len(eps_list) + max_iter)
+    if nr_not_converged > 0:
+        warnings.warn(
+            f"Sinkhorn did not converge to tol={tol} within max_iter="
+            f"{max_iter} iterations for {nr_not_converged} of {len(pred)} "
+            "samples, consider a larger blur"
+        )
+    return emd, n_iters
+
+
+def _kernel_sinkhorn_emd(pred, gt, C, eps_list, tol, max_iter, batch_size):
+    """
+    Matrix scaling part of sinkhorn_emd in the dtype of C, the transport
+    cost is not finite for the samples that under- or overflow
+    """
+    kernels = [torch.exp(-C / eps) for eps in eps_list]
+    # transport cost of the plan u_i K_ij v_j is u^T (K * C) v
+    cost_kernel = kernels[-1] * C
+    emd = np.zeros(len(pred))
+    n_iters = np.zeros(len(pred), dtype=int)
+    for start in range(0, len(pred), batch_size):
+        a = torch.from_numpy(pred[start : start + batch_size]).softmax(-1)
+        b = torch.from_numpy(gt[start : start + batch_size]).softmax(-1)
+        u, v, iters = kernel_sinkhorn(
+            a.to(C.dtype), b.to(C.dtype), kernels, eps_list, tol, max_iter
+        )
+        emd[start : start + batch_size] = torch.sum(
+            u * (v @ cost_kernel.T), dim=-1
+        ).numpy()
+        n_iters[start : start + batch_size] = iters.numpy()
+    return emd, n_iters
+
+
+def _log_sinkhorn_emd(pred, gt, dist_matrix, eps_list, tol, max_iter):
+    """
+    Log-domain fallback of sinkhorn_emd in float64, one sample at a time
+    because each iteration needs temporaries of the size of dist_matrix
+    """
+    C = torch.from_numpy(np.asarray(dist_matrix, dtype=np.float64))
+    emd = np.zeros(len(pred))
+    n_iters = np.zeros(len(pred), dtype=int)
+    for i in range(len(pred)):
+        a = torch.from_numpy(pred[i : i + 1]).softmax(-1)
+        b = torch.from_numpy(gt[i : i + 1]).softmax(-1)
+        f, g, iters = log_sinkhorn(a, b, C, eps_list, tol, max_iter)
+        plan = transport_plan(a.log(), b.log(), f, g, C, eps_list[-1])
+        emd[i] = torch.sum(plan * C).item()
+        n_iters[i] = iters.item()
+    return emd, n_iters
+
+
+def grid_sinkhorn_emd(
+    pred,
+    gt,
+    pred_coords,
+    gt_coords=None,
+    cell_size=None,
+    max_cells=64,
+    blur=0.1,
+    scaling=0.5,
+    tol=1e-3,
+    max_iter=200,
+    batch_size=1024,
+    per_location=False,
+):
+    """
+    Approximate EMD with convolutional Sinkhorn (on CPU): pred and gt are
+    rasterized onto a regular grid and the gaussian kernel is applied as
+    separable 1-D convolutions
+    pred: array of shape (nr_samples, nr_pred_locations), unnormalized
+    gt: array of shape (nr_samples, nr_gt_locations), unnormalized
+    pred_coords, gt_coords: locations in a projected CRS (meters),
+        gt_coords=None means that the gt is on the same locations as pred
+    cell_size, max_cells: see StationGrid
+    blur: target temperature, relative to the extent of the grid
+    per_location: also return the contribution of each location
+    Returns: square root of the debiased Sinkhorn divergence for the squared
+    euclidean cost (a W2 distance in meters), array of shape (nr_samples).
+    If per_location, also the contributions of the pred and gt locations to
+    the squared distance, arrays of shape (nr_samples, nr_locations)
+    """
+    if gt_coords is None:
+        gt_coords = pred_coords
+    # one grid for pred and gt
+    grid = StationGrid(
+        np.concatenate([pred_coords, gt_coords]),
+        cell_size,
+        max_cells,
+        device="cpu",
+    )
+    pred_cells = grid.cells[: len(pred_coords)]
+    gt_cells = grid.cells[len(pred_coords) :]
+
+    emd = np.zeros(len(pred))
+    pred_contrib = np.zeros(pred.shape)
+    gt_contrib = np.zeros(gt.shape)
+    for start in range(0, len(pred), batch_size):
+        a = torch.from_numpy(pred[start : start + batch_size]).softmax(-1)
+        b = torch.from_numpy(gt[start : start + batch_size]).softmax(-1)
+        a_grid = torch.zeros((len(a), grid.nr_cells), dtype=a.dtype)
+        a_grid.index_add_(-1, pred_cells, a)
+        b_grid = torch.zeros((len(b), grid.nr_cells), dtype=b.dtype)
+        b_grid.index_add_(-1, gt_cells, b)
+        (f_ba, g_ab, f_aa, g_bb), _ = grid_sinkhorn(
+            grid, a_grid, b_grid, blur, scaling, tol, max_iter
+        )
+        divergence = debiased_divergence(
+            a_grid, b_grid, f_ba, g_ab, f_aa, g_bb
+        )
+        emd[start : start + batch_size] = (
+            np.sqrt(np.clip(divergence.numpy(), 0, None)) * grid.scale
+        )
+        if per_location:
+            # scatter the potentials of the cells back to the locations
+            pred_contrib[start : start + batch_size] = (
+                a * grid.to_stations(f_ba - f_aa)[:, : len(pred_coords)]
+            ).numpy() * grid.scale**2
+            gt_contrib[start : start + batch_size] = (
+                b * grid.to_stations(g_ab - g_bb)[:, len(pred_coords) :]
+            ).numpy() * grid.scale**2
+    if per_location:
+        return emd, pred_contrib, gt_contrib
+    return emd
+
+
+def approximation_report(approx, exact):
+    """Summarize how far approximate EMD values deviate from the exact ones"""
+    approx, exact = np.asarray(approx), np.asarray(exact)
+    abs_error = np.abs(approx - exact)
+    rel_error = abs_error / np.clip(exact, 1e-12, None)
+    return {
+        "nr_samples": len(exact),
+        "mean_abs_error": float(np.mean(abs_error)),
+        "mean_rel_error": float(np.mean(rel_error)),
+        "max_rel_error": float(np.max(rel_error)),
+        "pearson": float(pearsonr(approx, exact)[0]),
+        "spearman": float(spearmanr(approx, exact)[0]),
+    }
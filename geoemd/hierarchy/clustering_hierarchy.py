@@ -1,4 +1,7 @@
 import json
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 from sklearn.cluster import KMeans, AgglomerativeClustering
 
 clustering_dict = {"kmeans": KMeans, "agg": AgglomerativeClustering}
@@ -20,25 +23,51 @@ class SpatialClustering:
         self.groups_coordinates = self.stations.groupby("cluster").agg(
             {"x": "mean", "y": "mean"}
         )
+        # integer code of the cluster of each station (clusters sorted by
+        # name, as in groupby)
+        self.cluster_names, self.cluster_codes = np.unique(
+            self.stations["cluster"].values, return_inverse=True
+        )
+
+    def cluster_indicator(self, station_ids):
+        """
+        Sparse indicator matrix (stations x clusters) for the given station
+        ids, which must all be in the index of the clustered stations
+        """
+        station_inds = self.stations.index.get_indexer(station_ids)
+        if np.any(station_inds < 0):
+            unknown = np.asarray(station_ids)[station_inds < 0]
+            raise ValueError(
+                f"{len(unknown)} stations are not clustered (e.g. "
+                f"{unknown[0]!r}), check that the station ids have the same "
+                "type as the index of the stations"
+            )
+        return sp.csr_matrix(
+            (
+                np.ones(len(station_inds), dtype=int),
+                (
+                    np.arange(len(station_inds)),
+                    self.cluster_codes[station_inds],
+                ),
+            ),
+            shape=(len(station_ids), len(self.cluster_names)),
+        )
 
     def transform_demand(self, demand_df_inp, hierarchy=False):
         """demand_df: Dataframe with rows = timestamps and columns=station ids"""
-        # merge with stations
-        demand_df = demand_df_inp.swapaxes(1, 0)
-        demand_df["cluster"] = self.stations["cluster"]
-        demand_grouped = demand_df.groupby("cluster").sum()
-        demand_grouped = demand_grouped.swapaxes(1, 0)
+        # sum up the demand per cluster with one sparse product
+        indicator = self.cluster_indicator(demand_df_inp.columns)
+        demand_grouped = pd.DataFrame(
+            (indicator.T @ demand_df_inp.values.T).T,
+            index=demand_df_inp.index,
+            columns=self.cluster_names,
+        )
         if hierarchy:
             total = demand_df_inp.sum(axis=1)
             demand_grouped = pd.concat([demand_df_inp, demand_grouped], axis=1)
             demand_grouped["total"] = total
 
-        demand_grouped = (
-            demand_grouped.reset_index()
-            .rename_axis(None, axis=1)
-            .set_index("timeslot")
-        )
-        return demand_grouped
+        return demand_grouped.rename_axis(None, axis=1)
 
     def get_topdown_hierarchy(self):
         station_cluster_dict = (
@@ -55,11 +84,15 @@ class SpatialClustering:
         return station_cluster_dict
 
     def get_darts_hier(self):
-        darts_hier = {}
-        for s_id in self.stations.index:
-            darts_hier[str(s_id)] = [self.stations.loc[s_id, "cluster"]]
-        for cluster_id in self.stations["cluster"].unique():
-            darts_hier[cluster_id] = ["total"]
+        darts_hier = dict(
+            zip(
+                self.stations.index.astype(str),
+                self.cluster_names[self.cluster_codes, None].tolist(),
+            )
+        )
+        darts_hier.update(
+            {cluster_id: ["total"] for cluster_id in self.cluster_names}
+        )
         return darts_hier
 
     def save(self, save_path):
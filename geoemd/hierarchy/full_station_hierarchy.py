@@ -1,87 +1,191 @@
 import os
 import json
+import numpy as np
 import pandas as pd
 
-from geoemd.hierarchy.hierarchy_utils import cluster_agglomerative
+from geoemd.hierarchy.hierarchy_utils import (
+    cluster_agglomerative,
+    accumulate_subtrees,
+    hierarchy_builders,
+)
+from geoemd.hierarchy.tree_index import TreeIndex
 
 
 class FullStationHierarchy:
     def __init__(self):
         print("Init object either from file or from stations_locations")
+        self._station_groups = None
+        self._hier = None
+        self._tree_index = None
+        self._summing_matrix = None
 
     def init_from_file(self, load_path):
-        self.station_groups = pd.read_csv(
-            os.path.join(load_path, "station_groups.csv"), index_col="group"
-        )
         with open(
             os.path.join(load_path, "station_hierarchy.json"), "r"
         ) as infile:
             self.hier = json.load(infile)
+        self.station_groups = pd.read_csv(
+            os.path.join(load_path, "station_groups.csv"), index_col="group"
+        )
 
     def init_from_station_locations(
         self, stations_locations, clustering_method=cluster_agglomerative
     ):
+        """
+        clustering_method: function returning the linkage of the stations
+            (and optionally the merge heights), or the name of one of the
+            hierarchy_builders, e.g. knn_ward for large point sets
+        """
         assert stations_locations.index.name == "station_id"
 
+        if isinstance(clustering_method, str):
+            clustering_method = hierarchy_builders[clustering_method]
         linkage = clustering_method(stations_locations)
-
-        # convert into dictionary as a basis for the new station-group df
-        station_groups = stations_locations.reset_index()
-        station_groups["nr_stations"] = 1
-        station_groups["group"] = (
-            station_groups["station_id"].astype(int).astype(str)
+        # the clustering method may also return the height of each merge,
+        # otherwise the merge order is used as height
+        heights = None
+        if isinstance(linkage, tuple):
+            linkage, heights = linkage
+        self.set_tree(
+            stations_locations.index.values,
+            linkage,
+            heights=heights,
+            coords=stations_locations[["x", "y"]].values,
         )
-        station_groups_dict = (
-            station_groups.drop(["station_id"], axis=1).swapaxes(1, 0).to_dict()
+
+    def set_tree(self, station_ids, linkage, heights=None, coords=None):
+        """
+        Store the tree as arrays over all nodes (first the N stations, then
+        the N - 1 merged groups in the order of the linkage)
+        station_ids: (N) ids of the stations
+        linkage: (N - 1, 2) children of each merge (as children_ of
+            sklearn's AgglomerativeClustering)
+        heights: (N - 1) height of each merge, default: merge order
+        coords: (N, 2) coordinates of the stations, default: NaN
+        """
+        nr_leaves = len(station_ids)
+        nr_nodes = 2 * nr_leaves - 1
+        linkage = np.asarray(linkage, dtype=int).reshape(-1, 2)
+        if heights is None:
+            heights = np.arange(1, nr_leaves)
+        if coords is None:
+            coords = np.full((nr_leaves, 2), np.nan)
+        self.station_ids = np.asarray(station_ids)
+        self.nr_leaves = nr_leaves
+
+        self.left = np.full(nr_nodes, -1)
+        self.right = np.full(nr_nodes, -1)
+        self.left[nr_leaves:], self.right[nr_leaves:] = linkage.T
+        self.parent = np.full(nr_nodes, -1)
+        self.parent[linkage.ravel()] = np.repeat(
+            np.arange(nr_leaves, nr_nodes), 2
         )
+        self.height = np.zeros(nr_nodes)
+        self.height[nr_leaves:] = heights
 
-        nr_samples = len(stations_locations)
+        # number of stations and centroid of every subtree
+        sums = accumulate_subtrees(
+            linkage,
+            np.column_stack([np.ones(nr_leaves), np.asarray(coords, float)]),
+        )
+        self.nr_stations = np.round(sums[:, 0]).astype(int)
+        self.x = sums[:, 1] / self.nr_stations
+        self.y = sums[:, 2] / self.nr_stations
+
+        self.group_names = np.concatenate(
+            [
+                self.station_ids.astype(int).astype(str),
+                ["Group_" + str(j) for j in range(nr_leaves - 1)],
+            ]
+        )
+        # derived views are rebuilt on access
+        self._station_groups = None
+        self._hier = None
+        self._tree_index = None
+        self._summing_matrix = None
+
+    @property
+    def linkage(self):
+        return np.column_stack(
+            [self.left[self.nr_leaves :], self.right[self.nr_leaves :]]
+        )
 
-        hier = {}
+    @property
+    def tree_index(self):
+        """TreeIndex for descendant queries, shared by all users"""
+        if self._tree_index is None:
+            self._tree_index = TreeIndex(self.parent, self.group_names)
+        return self._tree_index
 
-        for j, pair in enumerate(linkage):
-            node1, node2 = (
-                station_groups_dict[pair[0]],
-                station_groups_dict[pair[1]],
+    @property
+    def summing_matrix(self):
+        """
+        Sparse summing matrix S (groups x stations) with S[j, i] = 1 if
+        station i is in Group_j, in the order of station_ids. The demand of
+        all groups is demand @ S.T
+        """
+        if self._summing_matrix is None:
+            self._summing_matrix = self.tree_index.leaf_matrix(
+                self.group_names[: self.nr_leaves],
+                nodes=np.arange(self.nr_leaves, 2 * self.nr_leaves - 1),
             )
-
-            # init new node
-            new_node = {}
-            # compute running average of the coordinates
-            new_nr_stations = node1["nr_stations"] + node2["nr_stations"]
-            new_node["nr_stations"] = new_nr_stations
-            new_node["x"] = (
-                node1["x"] * node1["nr_stations"]
-                + node2["x"] * node2["nr_stations"]
-            ) / new_nr_stations
-            new_node["y"] = (
-                node1["y"] * node1["nr_stations"]
-                + node2["y"] * node2["nr_stations"]
-            ) / new_nr_stations
-
-            # add group name
-            new_node["group"] = "Group_" + str(j)
-
-            # add to overall dictionary
-            station_groups_dict[j + nr_samples] = new_node
-
-            # add to darts hierarchy
-            #         darts_hier[node1["group"]] = new_node["group"]
-            #         darts_hier[node2["group"]] = new_node["group"]
-            hier[new_node["group"]] = [node1["group"], node2["group"]]
-
-        station_groups = (
-            pd.DataFrame(station_groups_dict).swapaxes(1, 0).set_index("group")
+        return self._summing_matrix
+
+    @property
+    def station_groups(self):
+        """Dataframe with coordinates and number of stations per group"""
+        if self._station_groups is None:
+            self._station_groups = pd.DataFrame(
+                {"x": self.x, "y": self.y, "nr_stations": self.nr_stations},
+                index=pd.Index(self.group_names, name="group"),
+            )
+        return self._station_groups
+
+    @station_groups.setter
+    def station_groups(self, station_groups):
+        # e.g. loaded from a file or with additional prediction columns
+        self._station_groups = station_groups
+
+    @property
+    def hier(self):
+        """Dictionary mapping each group to its two children"""
+        if self._hier is None:
+            names = self.group_names
+            self._hier = dict(
+                zip(
+                    names[self.nr_leaves :].tolist(),
+                    np.column_stack(
+                        [
+                            names[self.left[self.nr_leaves :]],
+                            names[self.right[self.nr_leaves :]],
+                        ]
+                    ).tolist(),
+                )
+            )
+        return self._hier
+
+    @hier.setter
+    def hier(self, hier):
+        """Rebuild the tree arrays from a dictionary {Group_j: children}"""
+        groups = sorted(hier, key=lambda group: int(group.split("_")[-1]))
+        all_children = np.array([hier[group] for group in groups]).ravel()
+        station_ids = np.setdiff1d(all_children, groups)
+        station_ids = station_ids[np.argsort(station_ids.astype(int))]
+        node_index = pd.Series(
+            np.arange(len(station_ids) + len(groups)),
+            index=np.concatenate([station_ids, groups]),
         )
-        self.station_groups = station_groups
-        self.hier = hier
+        self.set_tree(station_ids, node_index[all_children].values)
+        self._hier = hier
 
     def get_darts_hier(self):
-        darts_hier = {}
-        for key, pair in self.hier.items():
-            for p in pair:
-                darts_hier[p] = key
-        return darts_hier
+        has_parent = self.parent >= 0
+        return dict(
+            zip(
+                self.group_names[has_parent].tolist(),
+                self.group_names[self.parent[has_parent]].tolist(),
+            )
+        )
 
     def deprecated_add_pred(self, pred_xa_col, col_name):
         """
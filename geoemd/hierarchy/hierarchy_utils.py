@@ -1,6 +1,12 @@
 import pandas as pd
 import numpy as np
-from sklearn.cluster import AgglomerativeClustering
+import scipy.sparse as sp
+from scipy.sparse.linalg import spsolve_triangular
+from scipy.cluster.hierarchy import linkage as exact_linkage
+from sklearn.cluster import AgglomerativeClustering, Birch
+from sklearn.neighbors import kneighbors_graph
+
+from geoemd.hierarchy.tree_index import TreeIndex
 
 
 def aggregate_bookings_deprecated(demand_df, agg_by="day"):
@@ -101,18 +107,222 @@ def test_hierarchy(bookings_agg, hierarchy, test_node=800):
 
 
 def cluster_agglomerative(station_locations):
+    """Returns: linkage (children_) and the height of each merge"""
     # cluster the stations
     clustering = AgglomerativeClustering(distance_threshold=0, n_clusters=None)
     clustering.fit(station_locations[["x", "y"]])
-    return clustering.children_
+    return clustering.children_, clustering.distances_
+
+
+def cluster_knn_ward(station_locations, n_neighbors=10):
+    """
+    Ward linkage constrained to the kNN graph of the stations, memory and
+    time scale with N * n_neighbors instead of N^2
+    Returns: linkage (children_) and the height of each merge
+    """
+    coords = station_locations[["x", "y"]].values
+    connectivity = kneighbors_graph(
+        coords, min(n_neighbors, len(coords) - 1), include_self=False
+    )
+    clustering = AgglomerativeClustering(
+        distance_threshold=0, n_clusters=None, connectivity=connectivity
+    )
+    clustering.fit(coords)
+    return clustering.children_, clustering.distances_
+
+
+def _micro_cluster_labels(coords, nr_micro_clusters, pre_aggregation):
+    """Assign the points to about nr_micro_clusters grid cells / subclusters"""
+    extent = np.max(np.ptp(coords, axis=0))
+    cell_size = max(extent / np.sqrt(nr_micro_clusters), 1e-9)
+    if pre_aggregation == "grid":
+        cells = np.floor((coords - coords.min(axis=0)) / cell_size)
+        return np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+    elif pre_aggregation == "birch":
+        birch = Birch(threshold=cell_size / 2, n_clusters=None).fit(coords)
+        return np.unique(birch.labels_, return_inverse=True)[1]
+    raise ValueError("pre_aggregation must be grid or birch")
+
+
+def cluster_preaggregated(
+    station_locations, nr_micro_clusters=1000, pre_aggregation="grid"
+):
+    """
+    Pre-aggregate the stations into micro-clusters (grid cells or BIRCH
+    subclusters), then build an exact Ward linkage within each micro-cluster
+    and an exact (unweighted) Ward linkage between the micro-cluster
+    centroids on top
+    Returns: linkage (children_) and the height of each merge
+    """
+    coords = station_locations[["x", "y"]].values.astype(float)
+    nr_leaves = len(coords)
+    labels = _micro_cluster_labels(coords, nr_micro_clusters, pre_aggregation)
+    nr_micro = labels.max() + 1 if nr_leaves > 0 else 0
+    order = np.argsort(labels, kind="stable")
+    bounds = np.searchsorted(labels[order], np.arange(nr_micro + 1))
+
+    children, heights = [np.zeros((0, 2), dtype=int)], [np.zeros(0)]
+    roots, centroids = np.zeros(nr_micro, dtype=int), np.zeros((nr_micro, 2))
+    next_node = nr_leaves
+    for k in range(nr_micro):
+        members = order[bounds[k] : bounds[k + 1]]
+        centroids[k] = coords[members].mean(axis=0)
+        roots[k] = members[0]
+        if len(members) == 1:
+            continue
+        # node ids of the local linkage: members, then the new merges
+        local = exact_linkage(coords[members], method="ward")
+        node_ids = np.r_[members, next_node + np.arange(len(members) - 1)]
+        children.append(node_ids[local[:, :2].astype(int)])
+        heights.append(local[:, 2])
+        next_node += len(members) - 1
+        roots[k] = next_node - 1
+    if nr_micro > 1:
+        top = exact_linkage(centroids, method="ward")
+        node_ids = np.r_[roots, next_node + np.arange(nr_micro - 1)]
+        children.append(node_ids[top[:, :2].astype(int)])
+        heights.append(top[:, 2])
+    return np.concatenate(children), np.concatenate(heights)
+
+
+def _two_means(points, nr_iter=10):
+    """
+    Split points into two groups with a few Lloyd iterations, initialized by
+    a split at the median along the principal axis
+    Returns: boolean array, True for the second group
+    """
+    centered = points - points.mean(axis=0)
+    direction = np.linalg.eigh(centered.T @ centered)[1][:, -1]
+    projection = centered @ direction
+    assign = projection > np.median(projection)
+    for _ in range(nr_iter):
+        if np.all(assign) or not np.any(assign):
+            break
+        dist_1 = np.sum((points - points[assign].mean(axis=0)) ** 2, axis=1)
+        dist_0 = np.sum((points - points[~assign].mean(axis=0)) ** 2, axis=1)
+        new_assign = dist_1 < dist_0
+        if np.all(new_assign == assign):
+            break
+        assign = new_assign
+    if np.all(assign) or not np.any(assign):
+        # identical points: split in half
+        assign = np.arange(len(points)) >= len(points) // 2
+    return assign
+
+
+def cluster_kmeans_bisection(station_locations, leaf_size=32):
+    """
+    Top-down tree by recursive 2-means bisection. Sets of at most leaf_size
+    stations are linked exactly with Ward. The merges are sorted by their
+    size, such that children always come before their parent
+    Returns: linkage (children_) and the height (Ward distance) of each merge
+    """
+    coords = station_locations[["x", "y"]].values.astype(float)
+    nr_leaves = len(coords)
+    nr_merges = max(nr_leaves - 1, 0)
+    children = np.zeros((nr_merges, 2), dtype=int)
+    sizes, heights = np.zeros(nr_merges), np.zeros(nr_merges)
+    next_merge = 0
+    # sets of stations and the slot (merge, side) where their node is linked
+    stack = [(np.arange(nr_leaves), None)] if nr_leaves > 1 else []
+    while len(stack) > 0:
+        members, slot = stack.pop()
+        if len(members) == 1:
+            node = members[0]
+        elif len(members) <= leaf_size:
+            local = exact_linkage(coords[members], method="ward")
+            local_merges = next_merge + np.arange(len(members) - 1)
+            node_ids = np.r_[members, nr_leaves + local_merges]
+            children[local_merges] = node_ids[local[:, :2].astype(int)]
+            sizes[local_merges] = local[:, 3]
+            heights[local_merges] = local[:, 2]
+            next_merge += len(members) - 1
+            node = nr_leaves + next_merge - 1
+        else:
+            assign = _two_means(coords[members])
+            size_0, size_1 = np.sum(~assign), np.sum(assign)
+            sizes[next_merge] = len(members)
+            heights[next_merge] = np.sqrt(
+                2 * size_0 * size_1 / len(members)
+            ) * np.linalg.norm(
+                coords[members[assign]].mean(axis=0)
+                - coords[members[~assign]].mean(axis=0)
+            )
+            stack.append((members[~assign], (next_merge, 0)))
+            stack.append((members[assign], (next_merge, 1)))
+            node = nr_leaves + next_merge
+            next_merge += 1
+        if slot is not None:
+            children[slot] = node
+
+    # children have fewer stations than their parent -> sort by size
+    order = np.argsort(sizes, kind="stable")
+    new_ids = np.r_[np.arange(nr_leaves), np.zeros(nr_merges, dtype=int)]
+    new_ids[nr_leaves + order] = nr_leaves + np.arange(nr_merges)
+    return new_ids[children[order]], heights[order]
+
+
+# builders of a full hierarchy, all return a linkage in the format of
+# AgglomerativeClustering.children_ and the height of each merge
+hierarchy_builders = {
+    "agglomerative": cluster_agglomerative,
+    "knn_ward": cluster_knn_ward,
+    "preaggregated": cluster_preaggregated,
+    "kmeans_bisection": cluster_kmeans_bisection,
+}
+
+
+def accumulate_subtrees(linkage, leaf_values):
+    """
+    Sum of the leaf values in the subtree of every node of a linkage
+    linkage: (N - 1, 2) children of each merge, merge j creates node N + j
+    leaf_values: (N) or (N, K) values of the leaves
+    Returns: (2N - 1) or (2N - 1, K) values of the leaves and merged nodes
+    The children of a merge always have a smaller index, so the sums are the
+    solution of the triangular system (I - A) s = v with the adjacency A from
+    each node to its children, solved in one compiled pass
+    """
+    nr_leaves = len(leaf_values)
+    nr_nodes = nr_leaves + len(linkage)
+    adjacency = sp.csr_matrix(
+        (
+            np.ones(2 * len(linkage)),
+            (
+                np.repeat(np.arange(nr_leaves, nr_nodes), 2),
+                np.asarray(linkage).ravel(),
+            ),
+        ),
+        shape=(nr_nodes, nr_nodes),
+    )
+    values = np.zeros((nr_nodes,) + np.shape(leaf_values)[1:])
+    values[:nr_leaves] = leaf_values
+    return spsolve_triangular(
+        sp.identity(nr_nodes, format="csr") - adjacency, values, lower=True
+    )
 
 
 def add_demand_groups(demand_agg, hier):
-    """Add groups of station to time series dataframe"""
+    """
+    Add groups of station to time series dataframe
+    hier: dictionary mapping each group to its children, or a TreeIndex
+        (e.g. FullStationHierarchy.tree_index)
+    All groups are computed with one sparse product with the summing matrix
+    """
     demand_agg.columns = demand_agg.columns.astype(str)
     demand_agg.index = pd.to_datetime(demand_agg.index)
-    for key, pair in hier.items():
-        demand_agg[key] = (
-            demand_agg[pair[0]].values + demand_agg[pair[1]].values
-        )
-    return demand_agg
+    if isinstance(hier, TreeIndex):
+        tree = hier
+        groups = np.where(~tree.is_leaf)[0]
+    else:
+        tree = TreeIndex.from_hier(hier)
+        # same order of the group columns as the dictionary
+        groups = tree.get_index(list(hier))
+    summing_matrix = tree.leaf_matrix(
+        demand_agg.columns, nodes=groups, dtype=demand_agg.values.dtype
+    )
+    group_demand = pd.DataFrame(
+        (summing_matrix @ demand_agg.values.T).T,
+        index=demand_agg.index,
+        columns=tree.names[groups],
+    )
+    return pd.concat([demand_agg, group_demand], axis=1)
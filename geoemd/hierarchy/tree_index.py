@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.linalg import spsolve_triangular
+
+
+class TreeIndex:
+    """
+    Integer index of a tree (or forest) for fast descendant queries. Nodes
+    are numbered such that children have a smaller index than their parent.
+    In depth-first (pre-)order, the nodes of every subtree and the leaves of
+    every subtree are contiguous, so the descendants of a node, the nodes at
+    a depth and the frontier some levels below a node are array slices
+    """
+
+    def __init__(self, parent, names=None):
+        """
+        parent: (M) index of the parent of each node, -1 for the root(s).
+            Children must have a smaller index than their parent (as for a
+            linkage). Siblings are ordered by their index
+        names: (M) names of the nodes, default: the indices
+        """
+        self.parent = np.asarray(parent, dtype=int)
+        nr_nodes = len(self.parent)
+        self.names = np.asarray(
+            np.arange(nr_nodes) if names is None else names
+        ).astype(str)
+        self.node_index = pd.Index(self.names)
+
+        has_parent = self.parent >= 0
+        self.is_leaf = (
+            np.bincount(self.parent[has_parent], minlength=nr_nodes) == 0
+        )
+        # adjacency from each node to its children, lower triangular
+        adjacency = sp.csr_matrix(
+            (
+                np.ones(np.sum(has_parent)),
+                (self.parent[has_parent], np.where(has_parent)[0]),
+            ),
+            shape=(nr_nodes, nr_nodes),
+        )
+        bottom_up = sp.identity(nr_nodes, format="csr") - adjacency
+        top_down = bottom_up.T.tocsr()
+
+        def solve(matrix, values, lower):
+            if nr_nodes == 0:
+                return np.zeros(0, dtype=int)
+            return np.round(
+                spsolve_triangular(matrix, values, lower=lower)
+            ).astype(int)
+
+        # subtree sizes (nodes and leaves): sums over the children
+        sizes = solve(
+            bottom_up,
+            np.column_stack([np.ones(nr_nodes), self.is_leaf]).astype(float),
+            lower=True,
+        ).reshape(nr_nodes, 2)
+        self.subtree_size, self.nr_leaves = sizes[:, 0], sizes[:, 1]
+        # depth: one more than the parent
+        self.depth = solve(top_down, has_parent.astype(float), lower=False)
+
+        # pre-order position: position of the parent + 1 + sizes of the
+        # earlier siblings (roots: sizes of the earlier roots)
+        sibling_order = np.lexsort((np.arange(nr_nodes), self.parent))
+        sizes_sorted = self.subtree_size[sibling_order]
+        parents_sorted = self.parent[sibling_order]
+        group_start = np.r_[True, parents_sorted[1:] != parents_sorted[:-1]]
+        cumsum = np.cumsum(sizes_sorted) - sizes_sorted
+        earlier_siblings = cumsum - np.maximum.accumulate(
+            np.where(group_start, cumsum, 0)
+        )
+        offset = np.zeros(nr_nodes)
+        offset[sibling_order] = earlier_siblings + (parents_sorted >= 0)
+        self.position = solve(top_down, offset, lower=False)
+        self.preorder = np.argsort(self.position)
+
+        # leaves in pre-order and the range of leaves of each node
+        self.leaf_order = self.preorder[self.is_leaf[self.preorder]]
+        self.leaf_start = np.searchsorted(
+            self.position[self.leaf_order], self.position
+        )
+        self.leaf_end = self.leaf_start + self.nr_leaves
+
+    @classmethod
+    def from_hier(cls, hier):
+        """
+        Index of a dictionary mapping each group to its children (groups or
+        stations), e.g. FullStationHierarchy.hier
+        """
+        hier = {
+            str(node): [str(child) for child in children]
+            for node, children in hier.items()
+        }
+        all_children = set(c for cs in hier.values() for c in cs)
+        roots = [node for node in hier if node not in all_children]
+        # number the nodes in post-order, such that children come first
+        names, parent_names = [], []
+        stack = [(root, None, False) for root in reversed(roots)]
+        while len(stack) > 0:
+            node, node_parent, expanded = stack.pop()
+            if node in hier and not expanded:
+                stack.append((node, node_parent, True))
+                for child in reversed(hier[node]):
+                    stack.append((child, node, False))
+                continue
+            names.append(node)
+            parent_names.append(node_parent)
+        node_pos = {name: i for i, name in enumerate(names)}
+        parent = [-1 if p is None else node_pos[p] for p in parent_names]
+        return cls(parent, names)
+
+    def get_index(self, nodes):
+        """Indices of nodes given by name"""
+        inds = self.node_index.get_indexer(np.asarray(nodes).astype(str))
+        if np.any(inds < 0):
+            raise KeyError(f"Nodes {np.asarray(nodes)[inds < 0]} not in tree")
+        return inds
+
+    def leaves(self, node):
+        """Indices of all leaves below a node (index)"""
+        return self.leaf_order[self.leaf_start[node] : self.leaf_end[node]]
+
+    def subtree(self, node):
+        """Indices of all nodes below a node (index), including the node"""
+        start = self.position[node]
+        return self.preorder[start : start + self.subtree_size[node]]
+
+    def nodes_at_depth(self, depth):
+        """Indices of all nodes at a depth (roots have depth 0), pre-order"""
+        return self.preorder[self.depth[self.preorder] == depth]
+
+    def frontier(self, node, levels_down):
+        """
+        Indices of the nodes levels_down below a node (index), and of the
+        leaves that are reached before, in pre-order
+        """
+        subtree = self.subtree(node)
+        target_depth = self.depth[node] + levels_down
+        depth = self.depth[subtree]
+        return subtree[
+            (depth == target_depth)
+            | (self.is_leaf[subtree] & (depth < target_depth))
+        ]
+
+    def leaf_matrix(self, columns, nodes=None, dtype=float):
+        """
+        Sparse indicator matrix (nodes x columns) of the leaves below each
+        node, e.g. the summing matrix of a hierarchy
+        columns: names of the leaves in the order of the columns (e.g. the
+            stations of the demand), all leaves must be among them
+        nodes: indices of the rows, default: all nodes
+        """
+        columns = np.asarray(columns).astype(str)
+        leaf_columns = pd.Index(columns).get_indexer(
+            self.names[self.leaf_order]
+        )
+        if np.any(leaf_columns < 0):
+            raise ValueError(
+                f"Leaves {self.names[self.leaf_order][leaf_columns < 0]} are"
+                " not in the columns"
+            )
+        nodes = np.arange(len(self.names)) if nodes is None else nodes
+        counts = self.nr_leaves[nodes]
+        indptr = np.r_[0, np.cumsum(counts)]
+        # the leaves of each node are a contiguous range in DFS order
+        positions = np.arange(indptr[-1]) + np.repeat(
+            self.leaf_start[nodes] - indptr[:-1], counts
+        )
+        return sp.csr_matrix(
+            (
+                np.ones(indptr[-1], dtype=dtype),
+                leaf_columns[positions],
+                indptr,
+            ),
+            shape=(len(nodes), len(columns)),
+        )
@@ -0,0 +1,148 @@
+import numpy as np
+import torch
+
+from geoemd.loss.sinkhorn_loss import device, default_dtype, folded_loss
+from geoemd.loss.sinkhorn_solver import (
+    debiased_divergence,
+    debiased_sinkhorn,
+    epsilon_schedule,
+)
+
+
+class StationGrid:
+    def __init__(self, coords, cell_size=None, max_cells=64, device=device):
+        """
+        Regular grid over the locations, used to rasterize demand
+        coords: (N, 2) array with x and y in a projected CRS (meters), e.g.
+            from preprocessing.bikes_montreal.project_locations
+        cell_size: side length of a cell in meters, default: such that the
+            longer side of the bounding box has max_cells cells
+        device: where the cell indices and kernels are stored
+        """
+        coords = np.asarray(coords, dtype=float)
+        origin = coords.min(axis=0)
+        extent = coords.max(axis=0) - origin
+        if cell_size is None:
+            cell_size = max(np.max(extent) / (max_cells - 1), 1e-9)
+        self.cell_size = cell_size
+        # (x, y) index of the cell of each location
+        cell_inds = np.round((coords - origin) / cell_size).astype(int)
+        self.width, self.height = cell_inds.max(axis=0) + 1
+        self.nr_cells = self.width * self.height
+        self.cells = torch.from_numpy(
+            cell_inds[:, 1] * self.width + cell_inds[:, 0]
+        ).to(device)
+        # costs are squared distances relative to the extent of the grid
+        self.scale = max(cell_size * np.hypot(self.width, self.height), 1e-9)
+        x = np.arange(self.width) * cell_size / self.scale
+        y = np.arange(self.height) * cell_size / self.scale
+        self.dx2 = torch.from_numpy((x[:, None] - x[None]) ** 2).to(device)
+        self.dy2 = torch.from_numpy((y[:, None] - y[None]) ** 2).to(device)
+
+    def rasterize(self, weights):
+        """Sum the weights (..., N) of the locations per cell (..., G)"""
+        grid = torch.zeros(
+            weights.size()[:-1] + (self.nr_cells,),
+            dtype=weights.dtype,
+            device=weights.device,
+        )
+        return grid.index_add(-1, self.cells, weights)
+
+    def to_stations(self, grid_values):
+        """Values of the cells (..., G) at the locations (..., N)"""
+        return grid_values[..., self.cells]
+
+    def softmin(self, eps, h):
+        """
+        Soft-c-transform for the squared euclidean cost on the grid
+        The gaussian kernel exp(-|x - y|^2 / eps) is separable, so the
+        log-sum-exp is computed as two products with 1-D kernels (along x,
+        then along y), each stabilized by the maximum along that axis
+        h: (B, G) log-weights plus potential / eps of the cells
+        """
+        batch_size = h.size()[0]
+        h = h.view(batch_size, self.height, self.width)
+        kernel_x = torch.exp(-self.dx2.to(h.dtype) / eps)
+        kernel_y = torch.exp(-self.dy2.to(h.dtype) / eps)
+        # along x: rows of the grid
+        row_max = torch.amax(h, dim=-1, keepdim=True)
+        row_max = torch.where(torch.isinf(row_max), 0, row_max)
+        h = row_max + torch.log(torch.exp(h - row_max) @ kernel_x)
+        # along y: columns of the grid
+        col_max = torch.amax(h, dim=-2, keepdim=True)
+        col_max = torch.where(torch.isinf(col_max), 0, col_max)
+        h = col_max + torch.log(kernel_y @ torch.exp(h - col_max))
+        return -eps * h.view(batch_size, -1)
+
+
+def grid_sinkhorn(grid, a, b, blur=0.1, scaling=0.5, tol=1e-3, max_iter=100):
+    """
+    Potentials of the debiased Sinkhorn divergence between rasterized
+    distributions a and b (B, G), computed without gradients in float64
+    blur: target temperature is blur^2, relative to the extent of the grid
+    Returns: potentials f_ba, g_ab, f_aa, g_bb and the number of iterations
+    """
+    with torch.no_grad():
+        a, b = a.double(), b.double()
+        potentials = [torch.zeros_like(a) for _ in range(4)]
+        potentials, n_iters = debiased_sinkhorn(
+            grid.softmin,
+            a,
+            b,
+            epsilon_schedule(1, blur**2, scaling),
+            potentials,
+            tol=tol,
+            max_iter=max_iter,
+        )
+    return potentials, n_iters
+
+
+class ConvolutionalSinkhornLoss:
+    def __init__(
+        self,
+        coords,
+        cell_size=None,
+        max_cells=64,
+        blur=0.1,
+        scaling=0.5,
+        tol=1e-3,
+        max_iter=100,
+        dtype=default_dtype,
+    ):
+        """
+        Debiased Sinkhorn loss on a regular grid: the predictions and targets
+        per location are rasterized and the gaussian kernel is applied as
+        two separable 1-D convolutions, so each iteration is O(G * (H + W))
+        instead of O(N^2). Gradients flow back to the locations through the
+        rasterization
+        coords: (N, 2) array with x and y of the components (meters)
+        dtype: precision of the loss, inputs are cast to it (the potentials
+            are always computed in float64, see grid_sinkhorn)
+        """
+        self.grid = StationGrid(coords, cell_size, max_cells)
+        self.blur = blur
+        self.scaling = scaling
+        self.tol = tol
+        self.max_iter = max_iter
+        self.dtype = dtype
+        self.n_iters = None
+
+    def row_loss(self, a, b):
+        """Sinkhorn divergence between the rows of a and b (B x N)"""
+        a = self.grid.rasterize(a)
+        b = self.grid.rasterize(b)
+        potentials, self.n_iters = grid_sinkhorn(
+            self.grid,
+            a,
+            b,
+            blur=self.blur,
+            scaling=self.scaling,
+            tol=self.tol,
+            max_iter=self.max_iter,
+        )
+        potentials = [p.to(a.dtype) for p in potentials]
+        return debiased_divergence(a, b, *potentials)
+
+    def __call__(self, a_in, b_in):
+        """a_in: predictions, b_in: targets"""
+        return folded_loss(self.row_loss, a_in, b_in, self.dtype)
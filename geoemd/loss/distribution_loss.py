@@ -1,12 +1,16 @@
 import torch
 from torch.nn import MSELoss, CrossEntropyLoss
 
+from geoemd.loss.sinkhorn_loss import default_dtype
+
 
 class DistributionMSE:
-    def __init__(self) -> None:
+    def __init__(self, dtype=default_dtype) -> None:
         self.standard_mse = MSELoss()
+        self.dtype = dtype
 
     def __call__(self, a_in, b_in):
+        a_in, b_in = a_in.to(self.dtype), b_in.to(self.dtype)
         # normalize a and b
         a = a_in.softmax(dim=-1)
         b = b_in.softmax(dim=-1)
@@ -16,10 +20,12 @@ class DistributionMSE:
 
 
 class StepwiseCrossentropy:
-    def __init__(self) -> None:
+    def __init__(self, dtype=default_dtype) -> None:
         self.standard_loss = CrossEntropyLoss()
+        self.dtype = dtype
 
     def __call__(self, inputs, targets_raw):
+        inputs, targets_raw = inputs.to(self.dtype), targets_raw.to(self.dtype)
         # convert targets into probabilities
         targets = targets_raw.softmax(dim=-1)
         # apply stepwise if predicting several steps --> not necessary!
@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import wasserstein
+
+from geoemd.loss.sinkhorn_loss import default_dtype, folded_loss
+
+# one network simplex solver per thread, reused for all items of that thread
+_thread_solvers = threading.local()
+
+
+def _solve_item(a, b, dist_matrix):
+    """
+    Exact EMD between a and b and the optimal dual potentials
+    Returns: emd, potential of a (N) and potential of b (M) such that
+        emd = sum(a * f) + sum(b * g) and f_i + g_j <= C_ij
+    """
+    if not hasattr(_thread_solvers, "solver"):
+        _thread_solvers.solver = wasserstein.EMD()
+    solver = _thread_solvers.solver
+    emd = solver(a, b, dist_matrix)
+    # the solver returns the node potentials with opposite signs for the
+    # sources, i.e. emd = sum(b * g) - sum(a * f)
+    f, g = solver.node_potentials()
+    f, g = -np.asarray(f), np.asarray(g)
+    # the potentials are only defined up to a constant shift (f + c, g - c)
+    shift = np.mean(f)
+    return emd, f - shift, g + shift
+
+
+class ExactEMDFunction(torch.autograd.Function):
+    """
+    Exact EMD between the rows of a (B x N) and b (B x M). The EMD is a
+    linear program, so its gradient with respect to the weights is given by
+    the optimal dual potentials
+    """
+
+    @staticmethod
+    def forward(ctx, a, b, dist_matrix, executor):
+        # the solver requires equal total weights, so renormalize in float64
+        a_np = a.detach().cpu().double().numpy()
+        b_np = b.detach().cpu().double().numpy()
+        a_np = a_np / np.sum(a_np, axis=-1, keepdims=True)
+        b_np = b_np / np.sum(b_np, axis=-1, keepdims=True)
+        map_fn = map if executor is None else executor.map
+        results = list(
+            map_fn(_solve_item, a_np, b_np, [dist_matrix] * len(a_np))
+        )
+        emd, f, g = zip(*results)
+        f = torch.from_numpy(np.stack(f)).to(a.device, a.dtype)
+        g = torch.from_numpy(np.stack(g)).to(b.device, b.dtype)
+        ctx.save_for_backward(f, g)
+        return torch.tensor(emd, dtype=a.dtype, device=a.device)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        f, g = ctx.saved_tensors
+        grad_output = grad_output.unsqueeze(-1)
+        return grad_output * f, grad_output * g, None, None
+
+
+class ExactEMDLoss:
+    def __init__(self, C, normalize_c=True, n_threads=4, dtype=default_dtype):
+        """
+        Exact EMD loss solved with the network simplex per (sample, step)
+        C: cost matrix between the locations (N x N)
+        n_threads: the items are solved concurrently in a pool of threads
+            (the solver releases the GIL), 1 solves them sequentially
+        dtype: precision of the loss and its gradient, inputs are cast to it
+            (the solver always works in float64)
+        """
+        if isinstance(C, torch.Tensor):
+            C = C.detach().cpu().numpy()
+        C = np.asarray(C, dtype=np.float64)
+        # normalize as in SinkhornLoss
+        if normalize_c:
+            C = C / np.sum(C)
+        self.dist_matrix = np.ascontiguousarray(C)
+        self.n_threads = n_threads
+        self.dtype = dtype
+        self.executor = None
+
+    def get_executor(self):
+        # created lazily, such that the loss can be pickled with the model
+        if self.executor is None and self.n_threads > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        return self.executor
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["executor"] = None
+        return state
+
+    def row_loss(self, a, b):
+        """Exact EMD between the rows of a and b (B x N)"""
+        return ExactEMDFunction.apply(
+            a, b, self.dist_matrix, self.get_executor()
+        )
+
+    def __call__(self, a_in, b_in):
+        """a_in: predictions, b_in: targets"""
+        return folded_loss(self.row_loss, a_in, b_in, self.dtype)
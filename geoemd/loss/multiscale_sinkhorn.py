@@ -0,0 +1,375 @@
+import numpy as np
+import torch
+from sklearn.cluster import KMeans
+
+from geoemd.loss.sinkhorn_loss import device, default_dtype, folded_loss
+from geoemd.loss.sinkhorn_solver import (
+    debiased_divergence,
+    debiased_sinkhorn,
+    epsilon_schedule,
+    log_sinkhorn,
+)
+
+
+def sparse_softmin(eps, rows, cols, costs, h, nr_rows):
+    """
+    Soft-c-transform on a sparse set of (row, col) pairs
+    h: (B, M) log-weights plus potential / eps of the columns
+    Returns: (B, nr_rows) potential of the rows
+    """
+    batch_size = h.size()[0]
+    vals = h[:, cols] - costs / eps
+    row_max = torch.full(
+        (batch_size, nr_rows), -torch.inf, dtype=h.dtype, device=h.device
+    ).scatter_reduce(1, rows.expand(batch_size, -1), vals, "amax")
+    row_max = row_max.detach()
+    # in place, the (B, nr_pairs) temporaries dominate the memory
+    sums = torch.zeros(
+        (batch_size, nr_rows), dtype=h.dtype, device=h.device
+    ).index_add_(1, rows, vals.sub_(row_max[:, rows]).exp_())
+    return -eps * (row_max + sums.log())
+
+
+def coarse_labels_from_hierarchy(station_hierarchy, components, nr_clusters):
+    """
+    Coarse cluster of each component (station or group) in a hierarchy
+    station_hierarchy: SpatialClustering (stations are assigned to their
+        cluster) or FullStationHierarchy (the tree is cut into nr_clusters
+        subtrees); components above the coarse level form their own cluster
+    components: names of the components, e.g. the columns of the demand
+    """
+    if hasattr(station_hierarchy, "hier"):
+        hier = station_hierarchy.hier
+        # groups are named by merge order, the last merges are the top ones
+        merge_order = sorted(hier, key=lambda group: int(group.split("_")[-1]))
+        top_groups = set(merge_order[len(merge_order) - nr_clusters + 1 :])
+        component_cluster = {}
+        for group in top_groups:
+            for child in hier[group]:
+                if child in top_groups:
+                    continue
+                # assign the whole subtree of the child to it
+                stack = [child]
+                while len(stack) > 0:
+                    node = stack.pop()
+                    component_cluster[node] = child
+                    stack.extend(hier.get(node, []))
+    else:
+        stations = station_hierarchy.stations
+        component_cluster = dict(
+            zip(stations.index.astype(str), stations["cluster"])
+        )
+    return np.array(
+        [
+            component_cluster.get(str(component), str(component))
+            for component in components
+        ]
+    )
+
+
+class MultiscaleSinkhornLoss:
+    def __init__(
+        self,
+        coords,
+        labels=None,
+        nr_clusters=None,
+        blur=0.05,
+        scaling=0.5,
+        truncate=5,
+        coarse_blur=None,
+        tol=1e-2,
+        max_iter=100,
+        max_entries=2**21,
+        dtype=default_dtype,
+    ):
+        """
+        Debiased Sinkhorn loss between distributions over located components
+        The cost (euclidean distance relative to the extent of the coords) is
+        computed on the fly. The problem is first solved between coarse
+        clusters, and on the fine level only the pairs of components with
+        significant transport are kept (kernel truncation), so the memory is
+        linear in the number of kept pairs instead of quadratic in N. The
+        kept pairs are roughly the ones closer than truncate * blur, so the
+        pattern is only sparse if that is small compared to the extent: for
+        uniform locations, blur 0.05 and truncate 5 keep 35-50% of the pairs
+        (relative error of the divergence around 1%), truncate 3 keeps
+        25-40% (error up to 8%) and blur 0.01 keeps a few percent.
+        coords: (N, 2) array with the x and y coordinates of the components
+        labels: (N) coarse cluster of each component, e.g. from
+            coarse_labels_from_hierarchy. If None, kmeans with nr_clusters
+            (default: sqrt(N)) is used
+        blur: target temperature (relative to the extent of the coords)
+        truncate: keep the pairs of components whose fine kernel at the
+            target temperature, estimated from the coarse potentials, is at
+            least exp(-truncate) times the largest one of their row or
+            column. The kept pairs are cached and only extended when a batch
+            needs more of them
+        coarse_blur: temperature at which the fine level starts, default:
+            largest distance of a component to its cluster centroid
+        tol, max_iter: at the target temperature, iterate until the marginal
+            errors are below tol (at most max_iter times)
+        max_entries: the samples are solved in chunks such that the
+            temporaries of shape (samples, pairs) have at most max_entries
+            entries, which bounds the memory independently of the batch size
+        dtype: precision of the computation, inputs are cast to it
+        """
+        coords = np.asarray(coords, dtype=float)
+        nr_components = len(coords)
+        if labels is None:
+            if nr_clusters is None:
+                nr_clusters = int(np.sqrt(nr_components))
+            labels = KMeans(
+                n_clusters=nr_clusters, n_init=1, random_state=0
+            ).fit(coords)
+            labels = labels.labels_
+        self.labels = np.unique(labels, return_inverse=True)[1]
+        self.nr_clusters = self.labels.max() + 1
+
+        # scale the coordinates such that all costs are between 0 and 1
+        coords = coords - coords.min(axis=0)
+        extent = np.linalg.norm(coords.max(axis=0))
+        self.coords = coords / (extent if extent > 0 else 1)
+        self.centroids = np.array(
+            [
+                self.coords[self.labels == k].mean(axis=0)
+                for k in range(self.nr_clusters)
+            ]
+        )
+        # components sorted by cluster, the members of cluster k are
+        # self.order[self.starts[k] : self.starts[k] + self.sizes[k]]
+        self.order = np.argsort(self.labels, kind="stable")
+        self.sizes = np.bincount(self.labels, minlength=self.nr_clusters)
+        self.starts = np.cumsum(self.sizes) - self.sizes
+        # largest distance of a member to its centroid
+        self.radii = np.zeros(self.nr_clusters)
+        np.maximum.at(
+            self.radii,
+            self.labels,
+            np.linalg.norm(self.coords - self.centroids[self.labels], axis=1),
+        )
+
+        self.blur = blur
+        self.scaling = scaling
+        self.truncate = truncate
+        self.tol = tol
+        self.max_iter = max_iter
+        self.max_entries = max_entries
+        self.dtype = dtype
+        if coarse_blur is None:
+            coarse_blur = np.max(self.radii)
+        self.coarse_blur = max(coarse_blur, blur)
+
+        self.coarse_cost = torch.cdist(
+            torch.from_numpy(self.centroids), torch.from_numpy(self.centroids)
+        ).to(device)
+        # lower bound of the cost between the members of two clusters
+        radii = torch.from_numpy(self.radii).to(device)
+        self.min_cost = torch.clamp(
+            self.coarse_cost - radii.unsqueeze(-1) - radii.unsqueeze(-2), min=0
+        )
+        # cost between each component and each centroid, to extend the
+        # coarse potentials to the components
+        self.point_cost = torch.cdist(
+            torch.from_numpy(self.coords), torch.from_numpy(self.centroids)
+        ).to(device)
+        # kept cluster pairs with their component pairs (candidates), and the
+        # kept component pairs among them. Both are cached and only extended
+        # when a batch needs pairs that are not in the pattern yet
+        self.keep = np.eye(self.nr_clusters, dtype=bool)
+        self.candidates = None
+        self.pair_mask = None
+        self.pairs = None
+        self.one_hot = torch.zeros(nr_components, self.nr_clusters)
+        self.one_hot[np.arange(nr_components), self.labels] = 1
+        self.one_hot = self.one_hot.to(device)
+        self.labels_tensor = torch.from_numpy(self.labels).to(device)
+
+    def fine_pairs(self, keep):
+        """
+        Pairs of components for a mask of kept cluster pairs, built per
+        cluster such that the temporaries stay small
+        """
+        rows, cols, costs = [], [], []
+        for k in range(self.nr_clusters):
+            members = self.order[
+                self.starts[k] : self.starts[k] + self.sizes[k]
+            ]
+            # components of all clusters that are kept with cluster k
+            partners = np.flatnonzero(keep[k][self.labels])
+            rows.append(np.repeat(members, len(partners)))
+            cols.append(np.tile(partners, len(members)))
+            costs.append(
+                np.linalg.norm(
+                    self.coords[members, None] - self.coords[None, partners],
+                    axis=-1,
+                ).ravel()
+            )
+        return tuple(
+            torch.from_numpy(np.concatenate(arrays)).to(device)
+            for arrays in [rows, cols, costs]
+        )
+
+    def get_candidates(self, keep):
+        """
+        Cached component pairs of a pattern of cluster pairs that includes
+        keep, and the index of the transposed pair of each pair
+        """
+        if self.candidates is None or np.any(keep & ~self.keep):
+            self.keep = self.keep | keep
+            # release the old pattern before building the new one
+            self.candidates, self.pairs = None, None
+            rows, cols, costs = self.fine_pairs(self.keep)
+            nr_components = len(self.labels)
+            pair_ids = rows * nr_components + cols
+            order = torch.argsort(pair_ids)
+            transpose = order[
+                torch.searchsorted(
+                    pair_ids[order], cols * nr_components + rows
+                )
+            ]
+            self.candidates = (rows, cols, costs, transpose)
+            self.pair_mask = None
+        return self.candidates
+
+    def get_pairs(self, pair_mask):
+        """Cached candidate pairs of a pattern that includes pair_mask"""
+        if self.pair_mask is None or torch.any(pair_mask & ~self.pair_mask):
+            if self.pair_mask is not None:
+                pair_mask = pair_mask | self.pair_mask
+            self.pair_mask = pair_mask
+            self.pairs = [
+                candidate[pair_mask] for candidate in self.candidates[:3]
+            ]
+        return self.pairs
+
+    def extend_potential(self, eps, y, g):
+        """
+        Potential of the components (B, N) from the coarse potential g of
+        the clusters with weights y (B, K), by a soft-c-transform
+        """
+        return -eps * torch.logsumexp(
+            y.log().unsqueeze(-2)
+            + (g.unsqueeze(-2) - self.point_cost.to(g.dtype)) / eps,
+            dim=-1,
+        )
+
+    def solve(self, a, b):
+        """
+        Dual potentials of the debiased problem between the rows of a and b,
+        computed without gradients, in chunks of rows (see max_entries)
+        Returns: f_ba, g_ab, f_aa, g_bb, each of shape (B, N)
+        """
+        nr_components = a.size()[-1]
+        potentials = []
+        start = 0
+        while start < a.size()[0]:
+            # the pattern of the previous chunks bounds the number of pairs,
+            # before the first one all pairs are possible
+            if self.candidates is None:
+                nr_pairs = nr_components**2
+            else:
+                nr_pairs = len(self.candidates[0])
+            stop = start + max(1, self.max_entries // nr_pairs)
+            potentials.append(self.solve_chunk(a[start:stop], b[start:stop]))
+            start = stop
+        return [torch.cat(chunks) for chunks in zip(*potentials)]
+
+    def solve_chunk(self, a, b):
+        """Dual potentials of the debiased problem for one chunk of rows"""
+        nr_components = a.size()[-1]
+
+        # coarse level: solve between the clusters, down to the target
+        # temperature such that the potentials estimate the fine kernel
+        one_hot = self.one_hot.to(a.dtype)
+        coarse_a, coarse_b = a @ one_hot, b @ one_hot
+        coarse_cost = self.coarse_cost.to(a.dtype)
+        min_cost = self.min_cost.to(a.dtype)
+        blur = self.blur
+        coarse_eps = epsilon_schedule(1, self.blur, self.scaling)
+        keep = torch.zeros(
+            (self.nr_clusters, self.nr_clusters),
+            dtype=torch.bool,
+            device=device,
+        )
+        extended = []
+        for x, y in [
+            (coarse_a, coarse_b),
+            (coarse_a, coarse_a),
+            (coarse_b, coarse_b),
+        ]:
+            f, g, _ = log_sinkhorn(x, y, coarse_cost, coarse_eps)
+            # log of the fine plan at the target temperature, estimated from
+            # the coarse potentials: the pairs below exp(-truncate) times the
+            # largest entry of their row and of their column are dropped.
+            # For clusters, bound it with the lowest cost between members
+            log_plan = x.log().unsqueeze(-1) + y.log().unsqueeze(-2)
+            log_plan = log_plan + (f.unsqueeze(-1) + g.unsqueeze(-2)) / blur
+            upper = log_plan - min_cost / blur
+            log_plan = log_plan - coarse_cost / blur
+            for dim in [-1, -2]:
+                best = torch.amax(log_plan, dim=dim, keepdim=True)
+                keep |= torch.any(upper > best - self.truncate, dim=0)
+            extended.append(
+                (
+                    self.extend_potential(coarse_eps[-1], y, g),
+                    self.extend_potential(coarse_eps[-1], x, f),
+                )
+            )
+        # symmetric pattern such that it can be used in both directions
+        keep = (keep | keep.T).cpu().numpy()
+        rows, cols, costs, transpose = self.get_candidates(keep)
+        costs = costs.to(a.dtype)
+
+        # same criterion for the component pairs of the kept cluster pairs,
+        # each component keeps at least the pair with itself
+        pair_mask = rows == cols
+        for (x, y), (f, g) in zip([(a, b), (a, a), (b, b)], extended):
+            log_plan = (f[:, rows] + g[:, cols]).sub_(costs).div_(blur)
+            log_plan.add_(x.log()[:, rows]).add_(y.log()[:, cols])
+            for index in [rows, cols]:
+                best = torch.full(
+                    (log_plan.size()[0], nr_components),
+                    -torch.inf,
+                    dtype=a.dtype,
+                    device=device,
+                ).scatter_reduce(
+                    1, index.expand(log_plan.size()[0], -1), log_plan, "amax"
+                )
+                pair_mask |= torch.any(
+                    log_plan > best[:, index].sub_(self.truncate), dim=0
+                )
+        rows, cols, costs = self.get_pairs(pair_mask | pair_mask[transpose])
+        costs = costs.to(a.dtype)
+
+        # fine level starts from the coarse potentials, extended to the
+        # components
+        (f_ba, g_ab), (f_aa, g_aa), (f_bb, g_bb) = extended
+        # the symmetric problems have a symmetric solution (f = g)
+        f_aa, g_bb = 0.5 * (f_aa + g_aa), 0.5 * (f_bb + g_bb)
+
+        def softmin(eps, h):
+            return sparse_softmin(eps, rows, cols, costs, h, nr_components)
+
+        # fine level: iterate until the marginal errors are small (the coarse
+        # initialization is only approximate)
+        fine_eps = epsilon_schedule(self.coarse_blur, self.blur, self.scaling)
+        potentials, _ = debiased_sinkhorn(
+            softmin,
+            a,
+            b,
+            fine_eps,
+            (f_ba, g_ab, f_aa, g_bb),
+            tol=self.tol,
+            max_iter=self.max_iter,
+        )
+        return potentials
+
+    def row_loss(self, a, b):
+        """Sinkhorn divergence between the rows of a and b (B x N)"""
+        with torch.no_grad():
+            f_ba, g_ab, f_aa, g_bb = self.solve(a, b)
+        return debiased_divergence(a, b, f_ba, g_ab, f_aa, g_bb)
+
+    def __call__(self, a_in, b_in):
+        """a_in: predictions, b_in: targets"""
+        return folded_loss(self.row_loss, a_in, b_in, self.dtype)
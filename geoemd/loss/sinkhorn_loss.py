@@ -1,14 +1,84 @@
+import time
+import warnings
 from typing import Any
 import geomloss
 import torch
 import numpy as np
 from torch.nn import MSELoss
 
+from geoemd.loss.sinkhorn_solver import (
+    epsilon_schedule,
+    log_sinkhorn,
+    symmetric_log_sinkhorn,
+)
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
+# precision of the losses and of their cost matrices, inputs are cast to it
+default_dtype = torch.float32
+
+
+def normalize_pred_gt(a_in, b_in):
+    """Convert predictions and targets into distributions over the locations"""
+    # # apply sigmoid to prediction
+    # a_in = torch.sigmoid(a_in)
+
+    # put b values to the same sum as the a values because then we get the
+    # same values
+    adim = a_in.dim() - 1
+    b_in = (
+        b_in
+        / torch.sum(b_in, dim=-1).unsqueeze(adim)
+        * torch.sum(a_in, dim=-1).detach().unsqueeze(adim)
+    )
+    # normalize a and b
+    a = (a_in * 2.71828).softmax(dim=-1)
+    b = (b_in * 2.71828).softmax(dim=-1)
+    return a, b
+
+
+def folded_loss(row_loss, a_in, b_in, dtype=default_dtype):
+    """
+    Loss between predictions a_in and targets b_in of shape (batch, N) or
+    (batch, steps ahead, N): they are cast to dtype and normalized, the steps
+    ahead are folded into the batch and solved together with row_loss
+    (distributions (B, N) -> loss per row), then the loss is averaged over
+    the steps and summed over the batch
+    """
+    batch_size = a_in.size()[0]
+    a, b = normalize_pred_gt(a_in.to(dtype), b_in.to(dtype))
+    loss = row_loss(a.reshape(-1, a.size()[-1]), b.reshape(-1, b.size()[-1]))
+    loss = torch.mean(loss.view(batch_size, -1), dim=1)
+    return torch.sum(loss)
 
 
 class SinkhornLoss:
-    def __init__(self, C, normalize_c=True, blur=0.5, **sinkhorn_kwargs):
+    def __init__(
+        self,
+        C,
+        normalize_c=True,
+        blur=0.5,
+        fold_horizon=device == "cuda",
+        warm_start=False,
+        tol=1e-3,
+        max_iter=2000,
+        dtype=default_dtype,
+        **sinkhorn_kwargs,
+    ):
+        """
+        C: cost matrix between the locations (N x N)
+        fold_horizon: solve all steps ahead at once (otherwise one solve per
+            step). Default only on the GPU, on the CPU the larger batched
+            solve is slower than the loop over the steps
+        warm_start: instead of geomloss, use the log-domain solver that
+            starts from the dual potentials of the previous call (cached
+            per batch size and step ahead) and stops once the marginal error
+            is below tol. A warning is raised if some samples need more than
+            max_iter iterations, which happens for a small blur relative to
+            the costs (geomloss does not converge there either, it stops
+            after annealing). The number of iterations of the last call is
+            stored in self.n_iters
+        dtype: precision of the cost matrix and of the computation
+        """
         if isinstance(C, np.ndarray):
             C = torch.from_numpy(C)
         # normalize to values betwen 0 and 1
@@ -19,14 +89,28 @@ class SinkhornLoss:
                 raise ValueError("cost matrix C must have 2 or 3 dimensions")
             C = C.unsqueeze(0)
 
-        # cost matrics and locs both need a static representation and are
-        # modified later to match the batch size
-        self.cost_matrix = C.to(device)
-        self.cost_matrix_original = self.cost_matrix.clone()
-        self.dummy_locs = torch.tensor(
-            [[[i] for i in range(C.size()[-1])]]
-        ).float()
-        self.dummy_locs_orig = self.dummy_locs.clone()
+        # a single cost matrix of shape (1, N, N) is shared by all batches and
+        # expanded to the batch size as a view, without copying it
+        self.dtype = dtype
+        self.cost_matrix = C.to(device=device, dtype=dtype)
+        # locations are only used by geomloss to infer the batch size and
+        # the diameter. They are small (B x N) but geomloss needs them
+        # contiguous, so they are materialized once per batch size
+        self.dummy_locs_orig = torch.arange(
+            C.size()[-1], dtype=dtype, device=device
+        ).view(1, -1, 1)
+        self.dummy_locs = {}
+        self.fold_horizon = fold_horizon
+
+        # warm start: target temperature as in geomloss (blur^p), potentials
+        # of the last call per batch size and step
+        self.warm_start = warm_start
+        self.eps = blur ** sinkhorn_kwargs.get("p", 2)
+        self.scaling = sinkhorn_kwargs.get("scaling", 0.5)
+        self.tol = tol
+        self.max_iter = max_iter
+        self.potentials = {}
+        self.n_iters = None
 
         # sinkhorn loss
         self.loss_object = geomloss.SamplesLoss(
@@ -39,70 +123,198 @@ class SinkhornLoss:
         )
 
     def get_cost(self, a, b):
-        return self.cost_matrix
+        return self.cost_matrix.expand(a.size()[0], -1, -1)
 
-    def __call__(self, a_in, b_in):
-        """a_in: predictions, b_in: targets"""
-        # Adapt cost matrix size to the batch size
-        batch_size = a_in.size()[0]
-        if self.cost_matrix.size()[0] != batch_size:
-            self.cost_matrix = self.cost_matrix_original.repeat(
+    def get_dummy_locs(self, batch_size):
+        if batch_size not in self.dummy_locs:
+            self.dummy_locs[batch_size] = self.dummy_locs_orig.repeat(
                 (batch_size, 1, 1)
             )
-            self.dummy_locs = self.dummy_locs_orig.repeat((batch_size, 1, 1))
-
-        # # apply sigmoid to prediction
-        # a_in = torch.sigmoid(a_in)
-
-        # put b values to the same sum as the a values because then we get the
-        # same values
-        adim = a_in.dim() - 1
-        b_in = (
-            b_in
-            / torch.sum(b_in, dim=-1).unsqueeze(adim)
-            * torch.sum(a_in, dim=-1).detach().unsqueeze(adim)
+        return self.dummy_locs[batch_size]
+
+    def solve(self, a, b, step=None):
+        """
+        Sinkhorn divergence between the rows of a and b (B x N)
+        step: step ahead of a and b (if solved per step), for warm starts
+        """
+        if self.warm_start:
+            return self.solve_warm_start(a, b, step)
+        dummy_locs = self.get_dummy_locs(a.size()[0])
+        # geomloss enables gradients at the end of its loop, so restore the
+        # grad mode of the caller (e.g. no_grad in validation)
+        with torch.set_grad_enabled(torch.is_grad_enabled()):
+            return self.loss_object(a, dummy_locs, b, dummy_locs)
+
+    def solve_warm_start(self, a, b, step=None):
+        # each step ahead has its own distributions, so they do not share
+        # their potentials
+        key = (a.size()[0], step)
+        C = self.cost_matrix[0]
+        init = self.potentials.get(key)
+        if init is None:
+            # cold start: anneal the temperature as geomloss does
+            eps_list = epsilon_schedule(
+                torch.max(C).item(), self.eps, self.scaling
+            )
+            init = [None] * 4
+        else:
+            eps_list = [self.eps]
+        solver_kwargs = {"tol": self.tol, "max_iter": self.max_iter}
+        with torch.no_grad():
+            f_ba, g_ab, iters_ab = log_sinkhorn(
+                a, b, C, eps_list, f=init[0], g=init[1], **solver_kwargs
+            )
+            f_aa, iters_aa = symmetric_log_sinkhorn(
+                a, C, eps_list, f=init[2], **solver_kwargs
+            )
+            g_bb, iters_bb = symmetric_log_sinkhorn(
+                b, C, eps_list, f=init[3], **solver_kwargs
+            )
+        self.potentials[key] = [f_ba, g_ab, f_aa, g_bb]
+        self.n_iters = torch.stack([iters_ab, iters_aa, iters_bb])
+        # samples that have not converged are counted in all iterations
+        nr_not_converged = torch.sum(
+            torch.any(self.n_iters >= len(eps_list) + self.max_iter, dim=0)
+        ).item()
+        if nr_not_converged > 0:
+            warnings.warn(
+                f"Sinkhorn did not converge to tol={self.tol} within "
+                f"max_iter={self.max_iter} iterations for {nr_not_converged} "
+                f"of {a.size()[0]} samples, consider a larger blur"
+            )
+        # the potentials are optimal, so the gradient of the divergence with
+        # respect to the weights is given by the potentials
+        return torch.sum(a * (f_ba - f_aa), dim=-1) + torch.sum(
+            b * (g_ab - g_bb), dim=-1
         )
-        # normalize a and b
-        a = (a_in * 2.71828).softmax(dim=-1)
-        b = (b_in * 2.71828).softmax(dim=-1)
+
+    def __call__(self, a_in, b_in):
+        """a_in: predictions, b_in: targets"""
+        a, b = normalize_pred_gt(a_in.to(self.dtype), b_in.to(self.dtype))
+        return self.divergence(a, b)
+
+    def divergence(self, a, b):
+        """
+        Summed loss between normalized distributions a and b, each of shape
+        (batch, N) or (batch, steps ahead, N)
+        """
+        batch_size = a.size()[0]
 
         # check if we predicted several steps ahead
-        steps_ahead = a.size()[1]
-        if a.dim() > 2 and steps_ahead > 1:
-            result = torch.empty((steps_ahead, batch_size))
+        if a.dim() > 2 and not self.fold_horizon:
+            steps_ahead = a.size()[1]
+            result = torch.empty(
+                (steps_ahead, batch_size), dtype=self.dtype, device=a.device
+            )
             for i in range(steps_ahead):
-                result[i] = self.loss_object(
-                    a[:, i], self.dummy_locs, b[:, i], self.dummy_locs
-                )
+                result[i] = self.solve(a[:, i], b[:, i], step=i)
             loss = torch.mean(result, dim=0)
+        elif a.dim() > 2:
+            # fold the steps into the batch and solve them together, then
+            # average over the steps as before
+            steps_ahead = a.size()[1]
+            nr_locs = a.size()[-1]
+            loss = self.solve(a.reshape(-1, nr_locs), b.reshape(-1, nr_locs))
+            loss = torch.mean(loss.view(batch_size, steps_ahead), dim=1)
         else:
-            loss = self.loss_object(a, self.dummy_locs, b, self.dummy_locs)
+            loss = self.solve(a, b)
         return torch.sum(loss)
 
 
 class CombinedLoss:
-    def __init__(self, C, dist_weight=0.9) -> None:
+    def __init__(
+        self,
+        C,
+        dist_weight=0.9,
+        sinkhorn_every=1,
+        sinkhorn_fraction=1.0,
+        dtype=default_dtype,
+    ) -> None:
+        """
+        Weighted sum of the MSE and the Sinkhorn loss
+        sinkhorn_every: compute the Sinkhorn term only every k-th call
+        sinkhorn_fraction: compute the Sinkhorn term only on a random subset
+            of this fraction of the samples in the batch
+        In both cases, the Sinkhorn term is rescaled (by k and by the inverse
+        of the subset fraction), such that its expectation over the calls is
+        the same as when computing it on every call with the full batch.
+        This only applies to training calls (gradients enabled), evaluation
+        calls always compute the full term and are not counted in nr_calls.
+        The accumulated runtimes of both terms are stored in self.timings
+        """
         self.standard_mse = MSELoss()
-        self.sinkhorn_error = SinkhornLoss(C)
+        self.sinkhorn_error = SinkhornLoss(C, dtype=dtype)
+        self.dtype = dtype
         self.dist_weight = dist_weight
+        self.sinkhorn_every = sinkhorn_every
+        self.sinkhorn_fraction = sinkhorn_fraction
+        self.nr_calls = 0
+        self.timings = {"mse": 0, "sinkhorn": 0}
+
+    def sinkhorn_term(self, a_in, b_in, amortize=True):
+        """
+        Rescaled Sinkhorn loss, possibly on a subset of the batch
+        amortize: if False, compute the loss on the full batch without
+            rescaling
+        """
+        if not amortize:
+            return self.sinkhorn_error.divergence(
+                *normalize_pred_gt(a_in, b_in)
+            )
+        batch_size = a_in.size()[0]
+        nr_selected = max(1, round(self.sinkhorn_fraction * batch_size))
+        if nr_selected < batch_size:
+            # sample subset and normalize only the selected samples
+            selected = torch.randperm(batch_size, device=a_in.device)
+            selected = selected[:nr_selected]
+            a_in, b_in = a_in[selected], b_in[selected]
+        a, b = normalize_pred_gt(a_in, b_in)
+        sink_loss = self.sinkhorn_error.divergence(a, b)
+        return sink_loss * (batch_size / nr_selected) * self.sinkhorn_every
 
     def __call__(self, a_in, b_in):
+        a_in, b_in = a_in.to(self.dtype), b_in.to(self.dtype)
+        tic = time.time()
         mse_loss = self.standard_mse(a_in, b_in)
-        sink_loss = self.sinkhorn_error(a_in, b_in)
+        self.timings["mse"] += time.time() - tic
+
+        # skip and subsample only in training, such that validation losses
+        # are exact and do not shift the schedule of the training calls
+        amortize = torch.is_grad_enabled() and a_in.requires_grad
+        if amortize:
+            compute_sinkhorn = self.nr_calls % self.sinkhorn_every == 0
+            self.nr_calls += 1
+            if not compute_sinkhorn:
+                return (1 - self.dist_weight) * mse_loss
+        tic = time.time()
+        sink_loss = self.sinkhorn_term(a_in, b_in, amortize=amortize)
+        self.timings["sinkhorn"] += time.time() - tic
         # for checking calibration of weighting
         # print((1 - self.dist_weight) * mse_loss, self.dist_weight * sink_loss)
         return (1 - self.dist_weight) * mse_loss + self.dist_weight * sink_loss
 
+    def timing_report(self):
+        """Runtime (forward pass only) of the MSE and the Sinkhorn term"""
+        total = sum(self.timings.values())
+        return (
+            f"CombinedLoss: {self.nr_calls} training calls, "
+            f"MSE {round(self.timings['mse'], 2)}s, "
+            f"Sinkhorn {round(self.timings['sinkhorn'], 2)}s "
+            f"({round(100 * self.timings['sinkhorn'] / max(total, 1e-9), 1)}%)"
+        )
+
 
-def sinkhorn_loss_from_numpy(a, b, cost_matrix, sinkhorn_kwargs={}):
-    a = torch.tensor(a.tolist()).float()
-    b = torch.tensor(b.tolist()).float()
+def sinkhorn_loss_from_numpy(
+    a, b, cost_matrix, sinkhorn_kwargs={}, dtype=default_dtype
+):
+    a = torch.as_tensor(np.asarray(a), dtype=dtype)
+    b = torch.as_tensor(np.asarray(b), dtype=dtype)
     # cost_matrix = torch.tensor([cost_matrix])
     # # Testing for the case where multiple steps ahead are predicted
     # a = a.unsqueeze(1).repeat(1, 3, 1)
     # b = b.unsqueeze(1).repeat(1, 3, 1)
     # print("Before initializing", cost_matrix.shape, a.size(), b.size())
-    loss = SinkhornLoss(cost_matrix, **sinkhorn_kwargs)
+    loss = SinkhornLoss(cost_matrix, dtype=dtype, **sinkhorn_kwargs)
     return loss(a, b)
 
 
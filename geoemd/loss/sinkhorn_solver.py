@@ -0,0 +1,205 @@
+import torch
+
+
+def epsilon_schedule(max_cost, blur, scaling=0.5):
+    """Decreasing temperatures from the maximum cost down to blur"""
+    eps_list = []
+    eps = max_cost
+    while eps > blur:
+        eps_list.append(eps)
+        eps = eps * scaling
+    eps_list.append(blur)
+    return eps_list
+
+
+def log_sinkhorn(a, b, C, eps_list, tol=1e-6, max_iter=1000, f=None, g=None):
+    """
+    Batched balanced Sinkhorn iterations in the log domain
+    a: (B, N) and b: (B, M) probability weights (rows sum up to 1)
+    C: (N, M) cost matrix, shared by all samples, or (B, N, M)
+    eps_list: temperatures, the last one is the target temperature at which
+        we iterate until the marginal error of all samples is below tol
+    f, g: initial dual potentials (e.g. from a previous, similar problem),
+        default: zero
+    Returns: dual potentials f (B, N) and g (B, M) at the target temperature
+        and the number of iterations per sample
+    """
+    a_log, b_log = a.log(), b.log()
+    f = torch.zeros_like(a) if f is None else f
+    g = torch.zeros_like(b) if g is None else g
+    n_iters = torch.zeros(a.size()[0], dtype=torch.long, device=a.device)
+    converged = torch.zeros(a.size()[0], dtype=torch.bool, device=a.device)
+    for it in range(len(eps_list) + max_iter):
+        eps = eps_list[min(it, len(eps_list) - 1)]
+        # alternating soft-c-transforms
+        f_new = -eps * torch.logsumexp(
+            b_log.unsqueeze(-2) + (g.unsqueeze(-2) - C) / eps, dim=-1
+        )
+        if it >= len(eps_list):
+            # the plan of (f, g) has exact column sums, and its row sums are
+            # a * exp((f - f_new) / eps) -> check them without an extra pass
+            marginal_error = torch.sum(
+                torch.abs(a * torch.expm1((f - f_new) / eps)), dim=-1
+            )
+            converged = marginal_error < tol
+            if torch.all(converged):
+                break
+        f = f_new
+        g = -eps * torch.logsumexp(
+            a_log.unsqueeze(-1) + (f.unsqueeze(-1) - C) / eps, dim=-2
+        )
+        n_iters[~converged] += 1
+    return f, g, n_iters
+
+
+def kernel_sinkhorn(a, b, kernels, eps_list, tol=1e-6, max_iter=1000):
+    """
+    Batched balanced Sinkhorn matrix scaling with Gibbs kernels that are
+    shared by all samples, such that each iteration is a matrix product.
+    Much faster than log_sinkhorn, but the scalings under- or overflow at
+    small temperatures (non-finite values in the returned scalings)
+    a: (B, N) and b: (B, M) probability weights (rows sum up to 1)
+    kernels: (N, M) kernels exp(-C / eps), one per temperature in eps_list
+    eps_list, tol, max_iter: as in log_sinkhorn
+    Returns: scalings u (B, N) and v (B, M) such that the plan at the target
+        temperature is u_i K_ij v_j, and the number of iterations per sample
+    """
+    u = torch.ones_like(a)
+    v = torch.ones_like(b)
+    n_iters = torch.zeros(a.size()[0], dtype=torch.long, device=a.device)
+    converged = torch.zeros(a.size()[0], dtype=torch.bool, device=a.device)
+    for it in range(len(kernels) + max_iter):
+        kernel = kernels[min(it, len(kernels) - 1)]
+        if 0 < it < len(kernels):
+            # exp(f / eps) at the new temperature from the one at the old
+            ratio = eps_list[it - 1] / eps_list[it]
+            u, v = u**ratio, v**ratio
+        kv = v @ kernel.T
+        if it >= len(kernels):
+            # the plan of (u, v) has exact column sums, its row sums are
+            # u * K v -> check them without an extra matrix product
+            marginal_error = torch.sum(torch.abs(u * kv - a), dim=-1)
+            # samples with non-finite scalings never converge
+            converged = (marginal_error < tol) | ~torch.isfinite(
+                marginal_error
+            )
+            if torch.all(converged):
+                break
+        u = a / kv
+        v = b / (u @ kernel)
+        n_iters[~converged] += 1
+    return u, v, n_iters
+
+
+def transport_plan(a_log, b_log, f, g, C, eps):
+    """Transport plan from the log-weights and the dual potentials"""
+    return torch.exp(
+        a_log.unsqueeze(-1)
+        + b_log.unsqueeze(-2)
+        + (f.unsqueeze(-1) + g.unsqueeze(-2) - C) / eps
+    )
+
+
+def symmetric_log_sinkhorn(a, C, eps_list, tol=1e-6, max_iter=1000, f=None):
+    """
+    Batched Sinkhorn iterations for the symmetric problem between a and
+    itself (debiasing term), with averaged updates that converge much faster
+    than alternating ones on this problem
+    a: (B, N) probability weights, C: symmetric (N, N) cost matrix
+    f: initial dual potential, default: zero
+    Returns: symmetric dual potential f (B, N) at the target temperature and
+        the number of iterations per sample
+    """
+    a_log = a.log()
+    f = torch.zeros_like(a) if f is None else f
+    n_iters = torch.zeros(a.size()[0], dtype=torch.long, device=a.device)
+    converged = torch.zeros(a.size()[0], dtype=torch.bool, device=a.device)
+    for it in range(len(eps_list) + max_iter):
+        eps = eps_list[min(it, len(eps_list) - 1)]
+        f_new = -eps * torch.logsumexp(
+            a_log.unsqueeze(-2) + (f.unsqueeze(-2) - C) / eps, dim=-1
+        )
+        if it >= len(eps_list):
+            # row sums of the plan of (f, f) are a * exp((f - f_new) / eps)
+            marginal_error = torch.sum(
+                torch.abs(a * torch.expm1((f - f_new) / eps)), dim=-1
+            )
+            converged = marginal_error < tol
+            if torch.all(converged):
+                break
+        f = 0.5 * (f + f_new)
+        n_iters[~converged] += 1
+    return f, n_iters
+
+
+def _log_weights_plus(w_log, p, eps):
+    # zero weights stay at -inf, whatever their (possibly infinite) potential
+    return torch.where(torch.isinf(w_log), w_log, w_log + p / eps)
+
+
+def debiased_sinkhorn(
+    softmin, a, b, eps_list, potentials, tol=1e-6, max_iter=1000
+):
+    """
+    Batched Sinkhorn iterations for the debiased Sinkhorn divergence between
+    a and b on the same support, with any soft-c-transform (dense, sparse or
+    separable on a grid)
+    softmin: function (eps, h) -> -eps * log(sum_j exp(h_j - C_ij / eps))
+    a, b: (B, N) probability weights, zero weights are allowed
+    eps_list: temperatures, the last one is the target temperature at which
+        we iterate until the marginal errors of all samples are below tol
+    potentials: initial potentials f_ba, g_ab, f_aa, g_bb, each (B, N)
+    Returns: potentials f_ba, g_ab, f_aa, g_bb at the target temperature
+        and the number of iterations
+    """
+    a_log, b_log = a.log(), b.log()
+    f_ba, g_ab, f_aa, g_bb = potentials
+    for it in range(len(eps_list) + max_iter):
+        eps = eps_list[min(it, len(eps_list) - 1)]
+        # alternating updates for the problem between a and b
+        ft_ba = softmin(eps, _log_weights_plus(b_log, g_ab, eps))
+        gt_ab = softmin(eps, _log_weights_plus(a_log, ft_ba, eps))
+        # symmetric (averaged) updates for the debiasing terms
+        ft_aa = softmin(eps, _log_weights_plus(a_log, f_aa, eps))
+        gt_bb = softmin(eps, _log_weights_plus(b_log, g_bb, eps))
+        # marginal errors: the plan of (ft_ba, g_ab) has exact row sums,
+        # its column sums are b * exp((g_ab - gt_ab) / eps)
+        errors = [
+            torch.sum(
+                torch.where(
+                    w > 0, torch.abs(w * torch.expm1((p - p_new) / eps)), 0
+                ),
+                dim=-1,
+            )
+            for w, p, p_new in [
+                (b, g_ab, gt_ab),
+                (a, f_aa, ft_aa),
+                (b, g_bb, gt_bb),
+            ]
+        ]
+        f_ba, g_ab = ft_ba, gt_ab
+        f_aa, g_bb = 0.5 * (f_aa + ft_aa), 0.5 * (g_bb + gt_bb)
+        if it >= len(eps_list) - 1 and all(
+            torch.all(error < tol) for error in errors
+        ):
+            break
+    # last extrapolation at the target temperature
+    f_ba, g_ab, f_aa, g_bb = (
+        softmin(eps, _log_weights_plus(b_log, g_ab, eps)),
+        softmin(eps, _log_weights_plus(a_log, f_ba, eps)),
+        softmin(eps, _log_weights_plus(a_log, f_aa, eps)),
+        softmin(eps, _log_weights_plus(b_log, g_bb, eps)),
+    )
+    return (f_ba, g_ab, f_aa, g_bb), it + 1
+
+
+def debiased_divergence(a, b, f_ba, g_ab, f_aa, g_bb):
+    """
+    Sinkhorn divergence per row from optimal potentials. The potentials are
+    optimal, so the gradient with respect to the weights a and b is given by
+    the potentials (they should be computed without gradients)
+    """
+    # potentials of zero weights may be infinite
+    diff_a = torch.where(a > 0, f_ba - f_aa, 0)
+    diff_b = torch.where(b > 0, g_ab - g_bb, 0)
+    return torch.sum(a * diff_a, dim=-1) + torch.sum(b * diff_b, dim=-1)
@@ -9,6 +9,8 @@ from geoemd.hierarchy.full_station_hierarchy import FullStationHierarchy
 class OptimalTransportLoss:
     def __init__(self, station_hierarchy: FullStationHierarchy):
         self.station_hierarchy = station_hierarchy
+        # shared index for the descendant queries
+        self.tree_index = station_hierarchy.tree_index
 
     def transport_from_centers(self, gt_col, pred_col):
         # create base stations
@@ -21,7 +23,7 @@ class OptimalTransportLoss:
         # for level, level_df in groups_with_preds.groupby("nr_stations"):
         for level in range(1, 12, 1):
             level_stations = get_children_hierarchy(
-                "Group_48", self.station_hierarchy.hier, level
+                "Group_48", self.tree_index, level
             )
             #     print(level_stations)
             #     print(level, level_stations)
@@ -60,11 +62,12 @@ class OptimalTransportLoss:
         # for each group, make one df which defines the distribution over
         # stations (given the prediction)
         distributed_preds = {}
-        for group in pred_per_group.index:
+        group_inds = self.tree_index.get_index(pred_per_group.index)
+        for group, group_ind in zip(pred_per_group.index, group_inds):
             pred_this_group = pred_per_group.loc[group]
-            stations_of_group = get_children_hierarchy(
-                group, self.station_hierarchy.hier, 100
-            )
+            stations_of_group = self.tree_index.names[
+                self.tree_index.leaves(group_ind)
+            ]
             distributed_preds[group] = pd.Series(
                 pred_this_group / len(stations_of_group),
                 index=stations_of_group,
@@ -73,7 +76,7 @@ class OptimalTransportLoss:
         # iterate over levels
         for level in range(1, 12, 1):
             level_stations = get_children_hierarchy(
-                "Group_48", self.station_hierarchy.hier, level
+                "Group_48", self.tree_index, level
             )
 
             # Gather all predictions per stations
@@ -2,6 +2,8 @@ import numpy as np
 import argparse
 import collections
 
+from geoemd.hierarchy.tree_index import TreeIndex
+
 
 def argument_parsing():
     parser = argparse.ArgumentParser()
@@ -83,17 +85,15 @@ def get_error_group_level(pred, val, station_groups):
 
 
 def get_children_hierarchy(group, hier, levels_down):
-    # wrapper function to avoid passing hier through all recursions
-    def get_children(group, levels_down):
-        if "Group" not in group or levels_down == 0:
-            return [group]
-        else:
-            children_list = []
-            for child in hier[group]:
-                children_list.extend(get_children(child, levels_down - 1))
-            return children_list
-
-    return get_children(group, levels_down)
+    """
+    Groups and stations levels_down below a group (including the stations
+    that are reached before)
+    hier: TreeIndex (e.g. FullStationHierarchy.tree_index) or dictionary
+        mapping each group to its children
+    """
+    tree = hier if isinstance(hier, TreeIndex) else TreeIndex.from_hier(hier)
+    node = tree.get_index([group])[0]
+    return tree.names[tree.frontier(node, levels_down)].tolist()
 
 
 def create_groups_with_pred(pred, val, step_ahead, station_groups):
@@ -5,6 +5,7 @@ import json
 import seaborn as sns
 
 from geoemd.emd_eval import EMDWrapper
+from geoemd.emd_cache import EMDCache
 
 
 def plot_error_evolvement(error_evolvement, out_path=None):
@@ -53,6 +54,9 @@ def plot_emd(path, out_path="figures"):
         .set_index("station_id")
     )
 
+    # one evaluator for all files; centroids and cost matrices are shared
+    # between files with the same hierarchy
+    emd_compute = EMDWrapper(stations, gt_reference, cache=EMDCache())
     emd_res_dict = {}
     for f in subset:
         print(f)
@@ -66,7 +70,6 @@ def plot_emd(path, out_path="figures"):
             # reduce to groups
             res = res[res["group"].str.contains("Group")]
 
-        emd_compute = EMDWrapper(stations, gt_reference)
         emd_vals = emd_compute(res, res_hierarchy, mode="group_to_group")
         emd_res_dict[subset_name_mapping[f[:-4]]] = emd_vals
 
@@ -0,0 +1,316 @@
+import os
+import gc
+import time
+import json
+import ctypes
+import platform
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+
+from geoemd.emd_eval import EMDWrapper, MODES, SOLVER_MODES
+from geoemd.emd_solvers import approximation_report
+
+SOLVERS = ["exact", "sparse", "tree", "sliced", "sinkhorn", "grid"]
+
+
+def synthetic_stations(nr_stations, extent=10000, seed=0):
+    """Random station layout in projected coordinates (meters)"""
+    rng = np.random.default_rng(seed)
+    stations = pd.DataFrame(
+        rng.uniform(0, extent, size=(nr_stations, 2)), columns=["x", "y"]
+    )
+    stations.index.name = "station_id"
+    return stations
+
+
+def synthetic_results(stations, nr_samples, steps_ahead=3, seed=0):
+    """
+    Random demand in the format of the result files of train_bikes
+    Returns: result dataframe and corresponding gt reference
+    """
+    rng = np.random.default_rng(seed)
+    samples, steps, station_ids = np.meshgrid(
+        np.arange(nr_samples),
+        np.arange(steps_ahead),
+        stations.index,
+        indexing="ij",
+    )
+    res = pd.DataFrame(
+        {
+            "group": station_ids.flatten(),
+            "steps_ahead": steps.flatten(),
+            "val_sample_ind": samples.flatten(),
+        }
+    )
+    res["gt"] = rng.poisson(1, size=len(res)).astype(float)
+    res["pred"] = np.clip(res["gt"] + rng.normal(0, 1, size=len(res)), 0, None)
+    gt_reference = res.drop("pred", axis=1)
+    return res, gt_reference
+
+
+def synthetic_grouping(stations, nr_cells=5):
+    """
+    Group the stations by a regular grid of nr_cells x nr_cells cells
+    Returns: hierarchy in the format of the result files {group: [stations]}
+    """
+    cells = []
+    for coord in ["x", "y"]:
+        edges = np.linspace(
+            stations[coord].min(), stations[coord].max(), nr_cells + 1
+        )
+        cells.append(np.digitize(stations[coord], edges[1:-1]))
+    cell_ids = cells[0] * nr_cells + cells[1]
+    return {
+        f"cell_{cell}": stations.index[cell_ids == cell].tolist()
+        for cell in np.unique(cell_ids)
+    }
+
+
+def aggregate_to_groups(res, res_hierarchy):
+    """Sum the station-level pred and gt of res within each group"""
+    station_to_group = {
+        station: group
+        for group, stations_in_group in res_hierarchy.items()
+        for station in stations_in_group
+    }
+    res_groups = res.assign(group=res["group"].map(station_to_group))
+    return res_groups.groupby(
+        ["val_sample_ind", "steps_ahead", "group"], as_index=False
+    )[["gt", "pred"]].sum()
+
+
+def subset_prepared(prepared, nr_rows):
+    """Restrict prepared predictions to the first nr_rows (sample, step)"""
+    subset = {}
+    for key, value in prepared.items():
+        if isinstance(value, (np.ndarray, pd.Index)) and key != "group_coords":
+            subset[key] = value[:nr_rows]
+        else:
+            subset[key] = value
+    return subset
+
+
+def time_call(func, *args):
+    tic = time.time()
+    result = func(*args)
+    return time.time() - tic, result
+
+
+def current_rss():
+    """Resident set size of the process in bytes (Linux)"""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def release_free_memory():
+    """
+    Return freed heap memory to the OS, such that it shows up in the RSS
+    again when it is reused (glibc only)
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def time_and_memory_call(func, *args, interval=0.001):
+    """
+    Time a call and measure its peak memory in MB: the largest increase of
+    the resident set size of the process, sampled in a background thread.
+    Unlike tracemalloc, this includes torch tensors and other allocations of
+    C extensions (but peaks shorter than the interval may be missed)
+    """
+    release_free_memory()
+    baseline = current_rss()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], current_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        runtime, result = time_call(func, *args)
+    finally:
+        done.set()
+        sampler.join()
+    peak = max(peak[0], current_rss())
+    return runtime, (peak - baseline) / 1024**2, result
+
+
+def benchmark_compute_emd(nr_stations, nr_samples, steps_ahead=3, n_workers=1):
+    stations = synthetic_stations(nr_stations)
+    res, gt_reference = synthetic_results(stations, nr_samples, steps_ahead)
+    emd_compute = EMDWrapper(stations, gt_reference)
+
+    res_per_station = res.copy()
+    res_per_station["pred_emd"] = res_per_station["pred"]
+    res_per_station["station"] = res_per_station["group"]
+
+    time_old, emd_old = time_call(
+        emd_compute.compute_emd_groupwise, res_per_station
+    )
+    time_new, emd_new = time_call(emd_compute.compute_emd, res_per_station)
+    assert np.allclose(emd_old, emd_new)
+    results = {
+        "nr_stations": nr_stations,
+        "nr_samples": nr_samples,
+        "steps_ahead": steps_ahead,
+        "groupwise_sec": round(time_old, 4),
+        "batched_sec": round(time_new, 4),
+        "speedup": round(time_old / time_new, 2),
+    }
+    if n_workers > 1:
+        emd_compute.n_workers = n_workers
+        time_parallel, emd_parallel = time_call(
+            emd_compute.compute_emd, res_per_station
+        )
+        assert np.allclose(emd_new, emd_parallel)
+        results[f"parallel_{n_workers}_sec"] = round(time_parallel, 4)
+        results["parallel_speedup"] = round(time_old / time_parallel, 2)
+    return results
+
+
+def benchmark_solvers(
+    nr_stations,
+    nr_samples,
+    solvers=SOLVERS,
+    modes=MODES,
+    steps_ahead=3,
+    nr_cells=5,
+    nr_error_rows=20,
+    n_workers=1,
+):
+    """
+    Time each solver of the EMDWrapper in each mode on a synthetic layout
+    The error is measured against the exact EMD on the first nr_error_rows
+    (sample, step) pairs, since the exact EMD is slow for large layouts
+    Returns: list of dictionaries, one per solver and mode
+    """
+    stations = synthetic_stations(nr_stations)
+    res_stations, gt_reference = synthetic_results(
+        stations, nr_samples, steps_ahead
+    )
+    res_hierarchy = synthetic_grouping(stations, nr_cells)
+    res_groups = aggregate_to_groups(res_stations, res_hierarchy)
+
+    exact_wrapper = None
+    results = []
+    for solver in solvers:
+        init_time, init_memory, emd_compute = time_and_memory_call(
+            lambda: EMDWrapper(
+                stations, gt_reference, solver=solver, n_workers=n_workers
+            )
+        )
+        if solver == "exact":
+            exact_wrapper = emd_compute
+        elif exact_wrapper is None:
+            exact_wrapper = EMDWrapper(stations, gt_reference)
+        prepared = emd_compute.prepare(res_groups, res_hierarchy)
+        error_subset = subset_prepared(prepared, nr_error_rows)
+        for mode in modes:
+            row = {
+                "nr_stations": nr_stations,
+                "nr_samples": nr_samples,
+                "steps_ahead": steps_ahead,
+                "nr_groups": len(res_hierarchy),
+                "solver": solver,
+                "mode": mode,
+                "init_sec": round(init_time, 4),
+                "init_memory_mb": round(init_memory, 2),
+            }
+            if mode not in SOLVER_MODES.get(solver, MODES):
+                row["error"] = f"Solver {solver} does not support mode {mode}"
+                results.append(row)
+                continue
+            runtime, memory, _ = time_and_memory_call(
+                emd_compute.evaluate, prepared, mode
+            )
+            row["sec"] = round(runtime, 4)
+            row["peak_memory_mb"] = round(memory, 2)
+            if solver != "exact":
+                report = approximation_report(
+                    emd_compute.evaluate(error_subset, mode),
+                    exact_wrapper.evaluate(error_subset, mode),
+                )
+                row.update(
+                    {
+                        key: report[key]
+                        for key in ["mean_rel_error", "max_rel_error"]
+                    }
+                )
+            results.append(row)
+    return results
+
+
+def environment_info():
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--benchmark",
+        type=str,
+        default="solvers",
+        choices=["solvers", "compute_emd"],
+        help="solvers: all solvers and modes, "
+        "compute_emd: batched vs groupwise",
+    )
+    parser.add_argument("--stations", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--samples", type=int, nargs="+", default=[50, 500])
+    parser.add_argument("--steps_ahead", type=int, default=3)
+    parser.add_argument("--n_workers", type=int, default=1)
+    parser.add_argument("--solvers", type=str, nargs="+", default=SOLVERS)
+    parser.add_argument("--modes", type=str, nargs="+", default=MODES)
+    parser.add_argument("--nr_error_rows", type=int, default=20)
+    parser.add_argument("--out_path", type=str, default=None)
+    args = parser.parse_args()
+
+    results = []
+    for nr_stations in args.stations:
+        for nr_samples in args.samples:
+            if args.benchmark == "compute_emd":
+                results.append(
+                    benchmark_compute_emd(
+                        nr_stations,
+                        nr_samples,
+                        steps_ahead=args.steps_ahead,
+                        n_workers=args.n_workers,
+                    )
+                )
+            else:
+                results.extend(
+                    benchmark_solvers(
+                        nr_stations,
+                        nr_samples,
+                        solvers=args.solvers,
+                        modes=args.modes,
+                        steps_ahead=args.steps_ahead,
+                        nr_error_rows=args.nr_error_rows,
+                        n_workers=args.n_workers,
+                    )
+                )
+    print(pd.DataFrame(results).to_string(index=False))
+    if args.out_path is not None:
+        with open(args.out_path, "w") as outfile:
+            json.dump(
+                {
+                    "benchmark": args.benchmark,
+                    "environment": environment_info(),
+                    "results": results,
+                },
+                outfile,
+                indent=4,
+            )
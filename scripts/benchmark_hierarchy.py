@@ -0,0 +1,81 @@
+import json
+import argparse
+import warnings
+import pandas as pd
+
+from geoemd.hierarchy.hierarchy_utils import hierarchy_builders
+from geoemd.hierarchy.full_station_hierarchy import FullStationHierarchy
+from benchmark_emd import synthetic_stations, time_and_memory_call
+from benchmark_emd import environment_info
+
+# quadratic memory, only run up to this number of points by default
+EXACT_BUILDERS = ["agglomerative"]
+
+
+def build_hierarchy(stations, builder):
+    station_hierarchy = FullStationHierarchy()
+    station_hierarchy.init_from_station_locations(
+        stations, clustering_method=builder
+    )
+    return station_hierarchy
+
+
+def benchmark_builders(nr_points, builders, max_exact=20000):
+    """Runtime and peak memory of building the full hierarchy"""
+    stations = synthetic_stations(nr_points)
+    results = []
+    for builder in builders:
+        if builder in EXACT_BUILDERS and nr_points > max_exact:
+            continue
+        runtime, peak_memory, station_hierarchy = time_and_memory_call(
+            build_hierarchy, stations, builder
+        )
+        results.append(
+            {
+                "nr_points": nr_points,
+                "builder": builder,
+                "runtime": round(runtime, 3),
+                "peak_memory_mb": round(peak_memory, 2),
+                "tree_depth": int(station_hierarchy.tree_index.depth.max()),
+            }
+        )
+        print(results[-1])
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--points", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument(
+        "--builders", type=str, nargs="+", default=list(hierarchy_builders)
+    )
+    parser.add_argument(
+        "--max_exact",
+        type=int,
+        default=20000,
+        help="largest number of points for the O(N^2) agglomerative builder",
+    )
+    parser.add_argument("--out_path", type=str, default=None)
+    args = parser.parse_args()
+
+    # sklearn warns about the kNN graph having several components
+    warnings.filterwarnings("ignore")
+    results = []
+    for nr_points in args.points:
+        results.extend(
+            benchmark_builders(nr_points, args.builders, args.max_exact)
+        )
+    print(pd.DataFrame(results).to_string(index=False))
+    if args.out_path is not None:
+        with open(args.out_path, "w") as outfile:
+            json.dump(
+                {
+                    "benchmark": "hierarchy",
+                    "environment": environment_info(),
+                    "results": results,
+                },
+                outfile,
+                indent=4,
+            )
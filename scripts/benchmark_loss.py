@@ -0,0 +1,210 @@
+import json
+import time
+import argparse
+import platform
+import itertools
+import numpy as np
+import pandas as pd
+import torch
+from scipy.spatial.distance import cdist
+
+from geoemd.loss.sinkhorn_loss import SinkhornLoss, CombinedLoss
+from geoemd.loss.multiscale_sinkhorn import MultiscaleSinkhornLoss
+from geoemd.loss.convolutional_sinkhorn import ConvolutionalSinkhornLoss
+from geoemd.loss.emd_loss import ExactEMDLoss
+from geoemd.loss.distribution_loss import StepwiseCrossentropy, DistributionMSE
+from benchmark_emd import time_and_memory_call
+
+# names as in --x_loss_function of train_bikes
+LOSSES = [
+    "sinkhorn",
+    "combined_sinkhorn",
+    "multiscale_sinkhorn",
+    "convolutional_sinkhorn",
+    "exact_emd",
+    "distribution",
+    "crossentropy",
+]
+
+
+def synthetic_locations(nr_locations, seed=0):
+    """Random locations in the unit square"""
+    rng = np.random.default_rng(seed)
+    return rng.uniform(size=(nr_locations, 2))
+
+
+def synthetic_cost_matrix(nr_locations, seed=0):
+    """Euclidean cost matrix between random locations"""
+    locations = synthetic_locations(nr_locations, seed)
+    return cdist(locations, locations)
+
+
+def make_loss(name, locations):
+    """Loss function as initialized in train_bikes"""
+    if name == "multiscale_sinkhorn":
+        return MultiscaleSinkhornLoss(locations)
+    elif name == "convolutional_sinkhorn":
+        return ConvolutionalSinkhornLoss(locations)
+    elif name == "distribution":
+        return DistributionMSE()
+    elif name == "crossentropy":
+        return StepwiseCrossentropy()
+    cost_matrix = cdist(locations, locations)
+    cost_matrix = cost_matrix / np.max(cost_matrix)
+    if name == "sinkhorn":
+        return SinkhornLoss(cost_matrix)
+    elif name == "combined_sinkhorn":
+        return CombinedLoss(cost_matrix)
+    elif name == "exact_emd":
+        return ExactEMDLoss(cost_matrix)
+    raise NotImplementedError(f"Unknown loss {name}")
+
+
+def time_forward_backward(loss_fn, pred, gt, nr_runs=3):
+    """Average time (sec) of the forward and of the backward pass"""
+    forward_times, backward_times = [], []
+    for _ in range(nr_runs):
+        pred_run = pred.detach().clone().requires_grad_(True)
+        tic = time.time()
+        loss = loss_fn(pred_run, gt)
+        forward_times.append(time.time() - tic)
+        tic = time.time()
+        loss.backward()
+        backward_times.append(time.time() - tic)
+    return np.mean(forward_times), np.mean(backward_times)
+
+
+def peak_memory_forward_backward(loss_fn, pred, gt):
+    """
+    Peak memory (MB) of one forward and backward pass, as the increase of
+    the resident set size of the process
+    """
+    pred_run = pred.detach().clone().requires_grad_(True)
+    _, peak_memory, _ = time_and_memory_call(
+        lambda: loss_fn(pred_run, gt).backward()
+    )
+    return peak_memory
+
+
+def benchmark_horizon(
+    output_chunk_length, batch_size=32, nr_locations=100, nr_runs=3
+):
+    """Compare the folded and the per-step Sinkhorn loss for one horizon"""
+    cost_matrix = synthetic_cost_matrix(nr_locations)
+    pred = torch.rand(batch_size, output_chunk_length, nr_locations)
+    gt = torch.rand(batch_size, output_chunk_length, nr_locations)
+
+    results = {
+        "output_chunk_length": output_chunk_length,
+        "batch_size": batch_size,
+        "nr_locations": nr_locations,
+    }
+    for name, fold_horizon in [("per_step", False), ("folded", True)]:
+        loss_fn = SinkhornLoss(cost_matrix, fold_horizon=fold_horizon)
+        forward_time, backward_time = time_forward_backward(
+            loss_fn, pred, gt, nr_runs=nr_runs
+        )
+        results[f"{name}_forward_sec"] = round(forward_time, 4)
+        results[f"{name}_backward_sec"] = round(backward_time, 4)
+    results["forward_speedup"] = round(
+        results["per_step_forward_sec"] / results["folded_forward_sec"], 2
+    )
+    results["backward_speedup"] = round(
+        results["per_step_backward_sec"] / results["folded_backward_sec"], 2
+    )
+    return results
+
+
+def benchmark_loss(
+    name, batch_size=32, nr_locations=100, output_chunk_length=3, nr_runs=3
+):
+    """Forward and backward time and peak memory of one loss function"""
+    loss_fn = make_loss(name, synthetic_locations(nr_locations))
+    pred = torch.rand(batch_size, output_chunk_length, nr_locations)
+    gt = torch.rand(batch_size, output_chunk_length, nr_locations)
+    # warm-up call, e.g. for caches of the batch size
+    time_forward_backward(loss_fn, pred, gt, nr_runs=1)
+    forward_time, backward_time = time_forward_backward(
+        loss_fn, pred, gt, nr_runs=nr_runs
+    )
+    return {
+        "loss": name,
+        "batch_size": batch_size,
+        "nr_locations": nr_locations,
+        "output_chunk_length": output_chunk_length,
+        "forward_sec": round(forward_time, 4),
+        "backward_sec": round(backward_time, 4),
+        "peak_memory_mb": round(
+            peak_memory_forward_backward(loss_fn, pred, gt), 2
+        ),
+    }
+
+
+def environment_info():
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "nr_threads": torch.get_num_threads(),
+        "machine": platform.machine(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--benchmark",
+        type=str,
+        default="losses",
+        choices=["losses", "horizon"],
+        help="losses: all loss functions, "
+        "horizon: folded vs per-step Sinkhorn",
+    )
+    parser.add_argument("--losses", type=str, nargs="+", default=LOSSES)
+    parser.add_argument(
+        "--output_chunk_length",
+        type=int,
+        nargs="+",
+        default=[1, 3, 6, 12, 24],
+    )
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[32])
+    parser.add_argument("--nr_locations", type=int, nargs="+", default=[100])
+    parser.add_argument("--nr_runs", type=int, default=3)
+    parser.add_argument("--out_path", type=str, default=None)
+    args = parser.parse_args()
+
+    results = []
+    for batch_size, nr_locations, output_chunk_length in itertools.product(
+        args.batch_size, args.nr_locations, args.output_chunk_length
+    ):
+        if args.benchmark == "horizon":
+            results.append(
+                benchmark_horizon(
+                    output_chunk_length,
+                    batch_size=batch_size,
+                    nr_locations=nr_locations,
+                    nr_runs=args.nr_runs,
+                )
+            )
+        else:
+            results.extend(
+                benchmark_loss(
+                    name,
+                    batch_size=batch_size,
+                    nr_locations=nr_locations,
+                    output_chunk_length=output_chunk_length,
+                    nr_runs=args.nr_runs,
+                )
+                for name in args.losses
+            )
+    print(pd.DataFrame(results).to_string(index=False))
+    output = {
+        "benchmark": args.benchmark,
+        "environment": environment_info(),
+        "results": results,
+    }
+    if args.out_path is not None:
+        with open(args.out_path, "w") as outfile:
+            json.dump(output, outfile, indent=4)
+    else:
+        print(json.dumps(output, indent=4))
@@ -1,41 +1,143 @@
-from scipy.stats import spearmanr
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import spearmanr, pearsonr
 import numpy as np
+import pandas as pd
+import torch
 from scipy.spatial.distance import cdist
-import matplotlib.pyplot as plt
 import wasserstein
-from geoemd.loss.sinkhorn_loss import sinkhorn_loss_from_numpy
+from geoemd.loss.sinkhorn_loss import (
+    SinkhornLoss,
+    normalize_pred_gt,
+    default_dtype,
+    device,
+)
 
 
-def compare_was(res, iters=300, sinkhorn_kwargs={}):
-    torch_res, emd_res = [], []
-    for _ in range(iters):
-        n_samples = 5  # np.random.randint(5, 40, 1)
-        rand_rows = res.sample(n_samples)
-        a = np.clip(rand_rows["pred"].values, 0, None)
-        if np.all(a == 0):
-            a = np.ones(len(a))
-        b = rand_rows["gt"].values
-        if np.all(b == 0):
-            b = np.ones(len(b))
-        test_cdist = rand_rows[["x", "y"]].values
-        test_cdist = cdist(test_cdist, test_cdist)
-
-        # 1) sinkhorn
-        torch_res.append(
-            sinkhorn_loss_from_numpy(
-                np.expand_dims(a, 0),
-                np.expand_dims(b, 0),
-                test_cdist,
-                sinkhorn_kwargs,
-            )
+def draw_samples(res, nr_draws, n_samples, seed=0):
+    """
+    Random subsets of n_samples rows of res, all drawn at once
+    Returns: weights a and b (nr_draws, n_samples) and the euclidean cost
+        matrices between the rows of each draw (nr_draws, n_samples, n_samples)
+    """
+    rng = np.random.default_rng(seed)
+    inds = np.stack(
+        [
+            rng.choice(len(res), n_samples, replace=False)
+            for _ in range(nr_draws)
+        ]
+    )
+    a = np.clip(res["pred"].values[inds], 0, None)
+    b = res["gt"].values[inds].astype(float)
+    a[np.all(a == 0, axis=1)] = 1
+    b[np.all(b == 0, axis=1)] = 1
+    coords = res[["x", "y"]].values[inds]
+    cost = np.linalg.norm(coords[:, :, None] - coords[:, None], axis=-1)
+    return a, b, cost
+
+
+def sinkhorn_sweep(a, b, cost, blurs, scalings, dtype=default_dtype):
+    """
+    Sinkhorn loss of all draws for each combination of blur and scaling,
+    every setting is solved in one batched call
+    a, b: (nr_draws, n) unnormalized weights
+    cost: (nr_draws, n, n) cost matrix per draw
+    Returns: dict {(blur, scaling): (array of losses, runtime in sec)}
+    """
+    # normalize each cost matrix as SinkhornLoss does for a single one
+    cost = cost / np.maximum(np.sum(cost, axis=(1, 2), keepdims=True), 1e-12)
+    a, b = normalize_pred_gt(
+        torch.as_tensor(a, dtype=dtype), torch.as_tensor(b, dtype=dtype)
+    )
+    results = {}
+    for blur, scaling in itertools.product(blurs, scalings):
+        tic = time.time()
+        loss = SinkhornLoss(
+            cost, normalize_c=False, blur=blur, scaling=scaling, dtype=dtype
+        )
+        with torch.no_grad():
+            sinkhorn_res = loss.solve(a.to(device), b.to(device))
+        results[(blur, scaling)] = (
+            sinkhorn_res.cpu().numpy(),
+            time.time() - tic,
         )
-        # 2) real wasserstein distance
+    return results
+
+
+def _exact_emd_chunk(a, b, cost):
+    was = wasserstein.EMD()
+    emd = np.zeros(len(a))
+    for i in range(len(a)):
         # normalize to values between 0 and 1
-        test_cdist = test_cdist / np.max(test_cdist)
-        a = a / np.sum(a)
-        b = b / np.sum(b)
-        was = wasserstein.EMD()
-        emd_res.append(was(a, b, test_cdist))
+        emd[i] = was(
+            a[i] / np.sum(a[i]),
+            b[i] / np.sum(b[i]),
+            cost[i] / max(np.max(cost[i]), 1e-12),
+        )
+    return emd
+
+
+def exact_emd_batch(a, b, cost, n_workers=4, chunk_size=64):
+    """Exact EMD of each draw, chunks of draws are solved in a process pool"""
+    starts = range(0, len(a), chunk_size)
+    chunks = [
+        [arr[s : s + chunk_size] for s in starts] for arr in [a, b, cost]
+    ]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            emd = list(pool.map(_exact_emd_chunk, *chunks))
+    else:
+        emd = list(map(_exact_emd_chunk, *chunks))
+    return np.concatenate(emd)
+
+
+def calibrate(
+    res,
+    blurs=[0.5],
+    scalings=[0.5],
+    sample_sizes=[5],
+    nr_draws=300,
+    n_workers=4,
+    dtype=default_dtype,
+):
+    """
+    Correlation of the Sinkhorn loss with the exact EMD on random subsets of
+    rows for a grid of settings
+    Returns: dataframe with one row per sample size, blur and scaling
+    """
+    table = []
+    for n_samples in sample_sizes:
+        a, b, cost = draw_samples(res, nr_draws, n_samples, seed=n_samples)
+        tic = time.time()
+        emd_res = exact_emd_batch(a, b, cost, n_workers=n_workers)
+        emd_runtime = time.time() - tic
+        sweep = sinkhorn_sweep(a, b, cost, blurs, scalings, dtype=dtype)
+        for (blur, scaling), (torch_res, runtime) in sweep.items():
+            table.append(
+                {
+                    "n_samples": n_samples,
+                    "blur": blur,
+                    "scaling": scaling,
+                    "spearman": spearmanr(torch_res, emd_res)[0],
+                    "pearson": pearsonr(torch_res, emd_res)[0],
+                    "sinkhorn_sec": runtime,
+                    "emd_sec": emd_runtime,
+                }
+            )
+    return pd.DataFrame(table)
+
+
+def compare_was(res, iters=300, sinkhorn_kwargs={}):
+    import matplotlib.pyplot as plt
+
+    blur = sinkhorn_kwargs.get("blur", 0.5)
+    scaling = sinkhorn_kwargs.get("scaling", 0.5)
+    a, b, cost = draw_samples(res, iters, n_samples=5)
+    sweep = sinkhorn_sweep(a, b, cost, [blur], [scaling])
+    torch_res = sweep[(blur, scaling)][0]
+    emd_res = exact_emd_batch(a, b, cost)
 
     print("Spearman", round(spearmanr(torch_res, emd_res)[0], 4))
     plt.scatter(torch_res, emd_res)
@@ -45,13 +147,18 @@ def compare_was(res, iters=300, sinkhorn_kwargs={}):
 
 
 def check_pred_gt(res, sinkhorn_kwargs={}):
+    """
+    Sinkhorn loss and exact EMD between each model prediction and the ground
+    truth, for the steps ahead 0 to 4
+    Returns: dataframe with the step, the prediction column and both losses
+    """
     res_stations = res[~res.index.str.contains("Group")]
 
     test_cdist = res_stations[["x", "y"]].values
     test_cdist = cdist(test_cdist, test_cdist)
     test_cdist_normed = test_cdist / np.max(test_cdist)
 
-    torch_res, emd_res = [], []
+    pairs, a_collect, gt_collect = [], [], []
     for i in range(5):
         gt_vals = res_stations["gt_" + str(i)].values
         gt_vals = gt_vals / np.sum(gt_vals)
@@ -59,29 +166,56 @@ def check_pred_gt(res, sinkhorn_kwargs={}):
         model_pred_cols = [
             c for c in res.columns if "_" + str(i) in c and c.startswith("pred")
         ]
-
         for model_pred in model_pred_cols:
             a = res_stations[model_pred].values
-            a = a / np.sum(a)
+            a_collect.append(a / np.sum(a))
+            gt_collect.append(gt_vals)
+            pairs.append((i, model_pred))
+    a_collect, gt_collect = np.stack(a_collect), np.stack(gt_collect)
 
-            torch_res.append(
-                sinkhorn_loss_from_numpy(
-                    a, gt_vals, test_cdist_normed, sinkhorn_kwargs
-                )
-            )
-            was = wasserstein.EMD()
-            emd_res.append(was(a, gt_vals, test_cdist_normed))
+    # all pairs share the cost matrix, so they are solved in one batch
+    loss = SinkhornLoss(test_cdist_normed, **sinkhorn_kwargs)
+    a, b = normalize_pred_gt(
+        torch.as_tensor(a_collect, dtype=loss.dtype, device=device),
+        torch.as_tensor(gt_collect, dtype=loss.dtype, device=device),
+    )
+    with torch.no_grad():
+        torch_res = loss.solve(a, b).cpu().numpy()
+    emd_res = _exact_emd_chunk(
+        a_collect,
+        gt_collect,
+        np.broadcast_to(test_cdist_normed, (len(pairs),) + test_cdist.shape),
+    )
     #     emd_unnormed.append(was(a, gt_vals, test_cdist))
+    return pd.DataFrame(pairs, columns=["steps_ahead", "model_pred"]).assign(
+        sinkhorn=torch_res, emd=emd_res
+    )
 
 
 if __name__ == "__main__":
-    import pandas as pd
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--in_path", type=str, default="outputs/comp_17_05_all/"
+    )
+    parser.add_argument(
+        "--model_path", type=str, default="0_24_1_nhits_multi_50_3_3_0.csv"
+    )
+    parser.add_argument(
+        "--stations_path",
+        type=str,
+        default="../data/bikes_montreal/test_stations.csv",
+    )
+    parser.add_argument("--blur", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--scaling", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--sample_sizes", type=int, nargs="+", default=[5])
+    parser.add_argument("--nr_draws", type=int, default=300)
+    parser.add_argument("--n_workers", type=int, default=4)
+    parser.add_argument("--out_path", type=str, default=None)
+    args = parser.parse_args()
 
-    in_path = "outputs/comp_17_05_all/"
-    model_path = "0_24_1_nhits_multi_50_3_3_0.csv"
-    res_gt = pd.read_csv(in_path + "gt.csv")
-    res_pred = pd.read_csv(in_path + model_path)
-    station_groups = pd.read_csv("../data/bikes_montreal/test_stations.csv")
+    res_gt = pd.read_csv(args.in_path + "gt.csv")
+    res_pred = pd.read_csv(args.in_path + args.model_path)
+    station_groups = pd.read_csv(args.stations_path)
     together = res_pred.merge(
         res_gt,
         left_on=["group", "steps_ahead", "val_sample_ind"],
@@ -91,4 +225,14 @@ if __name__ == "__main__":
     together = together.merge(
         station_groups, how="left", left_on="group", right_on="station_id"
     )
-    compare_was(together)
+    table = calibrate(
+        together,
+        blurs=args.blur,
+        scalings=args.scaling,
+        sample_sizes=args.sample_sizes,
+        nr_draws=args.nr_draws,
+        n_workers=args.n_workers,
+    )
+    print(table.round(4).to_string(index=False))
+    if args.out_path is not None:
+        table.to_csv(args.out_path, index=False)
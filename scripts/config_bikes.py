@@ -2,3 +2,13 @@ TRAIN_CUTOFF = 0.9
 TEST_SAMPLES = 50  # number of time points where we start a prediction
 STEPS_AHEAD = 3
 MAX_RENTALS = 1000  # how many rentals we expect maximally
+# combined_sinkhorn loss: compute the Sinkhorn term only every k-th batch and
+# on a fraction of the samples (1 and 1.0: always on the full batch)
+SINKHORN_EVERY = 1
+SINKHORN_FRACTION = 1.0
+# precision of the losses and cost matrices ("float32" or "float64")
+LOSS_DTYPE = "float32"
+# builder of the full station hierarchy (see
+# hierarchy_utils.hierarchy_builders), e.g. knn_ward or preaggregated for
+# large (dockless) point sets
+HIERARCHY_BUILDER = "agglomerative"
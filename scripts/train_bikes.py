@@ -2,6 +2,7 @@ import os
 import pandas as pd
 import time
 import numpy as np
+import torch
 from darts import TimeSeries, concatenate
 from darts.dataprocessing.transformers import MinTReconciliator
 from scipy.spatial.distance import cdist
@@ -12,8 +13,23 @@ from geoemd.hierarchy.full_station_hierarchy import FullStationHierarchy
 from geoemd.hierarchy.clustering_hierarchy import SpatialClustering
 from geoemd.utils import argument_parsing, construct_name
 from geoemd.loss.sinkhorn_loss import SinkhornLoss, CombinedLoss
+from geoemd.loss.multiscale_sinkhorn import (
+    MultiscaleSinkhornLoss,
+    coarse_labels_from_hierarchy,
+)
+from geoemd.loss.convolutional_sinkhorn import ConvolutionalSinkhornLoss
+from geoemd.loss.emd_loss import ExactEMDLoss
 from geoemd.loss.distribution_loss import StepwiseCrossentropy, DistributionMSE
-from config_bikes import STEPS_AHEAD, TRAIN_CUTOFF, TEST_SAMPLES, MAX_RENTALS
+from config_bikes import (
+    STEPS_AHEAD,
+    TRAIN_CUTOFF,
+    TEST_SAMPLES,
+    MAX_RENTALS,
+    SINKHORN_EVERY,
+    SINKHORN_FRACTION,
+    LOSS_DTYPE,
+    HIERARCHY_BUILDER,
+)
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -164,7 +180,13 @@ def test_models(
 
         # Clean: (transform to df, clip, etc)
         # if loss function is just distribution, we apply exp to the results
-        apply_exp = kwargs["x_loss_function"] in ["sinkhorn", "distribution"]
+        apply_exp = kwargs["x_loss_function"] in [
+            "sinkhorn",
+            "multiscale_sinkhorn",
+            "convolutional_sinkhorn",
+            "exact_emd",
+            "distribution",
+        ]
         result_as_df = clean_single_pred(pred, clip=True, apply_exp=apply_exp)
         # add info about val sample
         result_as_df["val_sample_ind"] = val_sample - train_cutoff
@@ -206,8 +228,12 @@ if __name__ == "__main__":
             stations_locations = stations_locations[
                 stations_locations.index != 0
             ]
-        station_hierarchy.init_from_station_locations(stations_locations)
-        demand_agg = add_demand_groups(demand_agg, station_hierarchy.hier)
+        station_hierarchy.init_from_station_locations(
+            stations_locations, clustering_method=HIERARCHY_BUILDER
+        )
+        demand_agg = add_demand_groups(
+            demand_agg, station_hierarchy.tree_index
+        )
     elif args.y_clustermethod is not None:
         station_hierarchy = SpatialClustering(stations_locations)
         station_hierarchy(
@@ -237,7 +263,11 @@ if __name__ == "__main__":
     out_name, training_kwargs = construct_name(args)
 
     # Initialize loss function
-    if "sinkhorn" in args.x_loss_function:
+    loss_dtype = getattr(torch, LOSS_DTYPE)
+    if (
+        "sinkhorn" in args.x_loss_function
+        or args.x_loss_function == "exact_emd"
+    ):
         # sort stations by the same order as the demand columns
         if args.y_clustermethod is not None:
             station_coords = station_hierarchy.groups_coordinates.loc[
@@ -247,18 +277,54 @@ if __name__ == "__main__":
             station_coords = stations_locations.loc[
                 demand_agg.columns, ["x", "y"]
             ].values
-        station_cdist = cdist(station_coords, station_coords)
-        station_cdist = station_cdist / np.max(station_cdist)
-        if args.x_loss_function == "sinkhorn":
-            training_kwargs["loss_fn"] = SinkhornLoss(station_cdist)
-        elif args.x_loss_function == "combined_sinkhorn":
-            training_kwargs["loss_fn"] = CombinedLoss(station_cdist)
+        if args.x_loss_function == "multiscale_sinkhorn":
+            # cost is computed on the fly from the coordinates. With a
+            # hierarchy, the components are stations and groups, and the
+            # coarse level is a cut of the hierarchy. Otherwise, it is found
+            # by kmeans on the coordinates of the components
+            labels = None
+            if args.hierarchy:
+                labels = coarse_labels_from_hierarchy(
+                    station_hierarchy,
+                    demand_agg.columns,
+                    int(np.sqrt(len(demand_agg.columns))),
+                )
+            training_kwargs["loss_fn"] = MultiscaleSinkhornLoss(
+                station_coords, labels=labels, dtype=loss_dtype
+            )
+        elif args.x_loss_function == "convolutional_sinkhorn":
+            # demand is rasterized on a grid of the projected coordinates
+            training_kwargs["loss_fn"] = ConvolutionalSinkhornLoss(
+                station_coords, dtype=loss_dtype
+            )
         else:
-            raise NotImplementedError("Must be sinhorn or combined_sinkhorn")
+            station_cdist = cdist(station_coords, station_coords)
+            station_cdist = station_cdist / np.max(station_cdist)
+            station_cdist = station_cdist.astype(LOSS_DTYPE)
+            if args.x_loss_function == "sinkhorn":
+                training_kwargs["loss_fn"] = SinkhornLoss(
+                    station_cdist, dtype=loss_dtype
+                )
+            elif args.x_loss_function == "combined_sinkhorn":
+                training_kwargs["loss_fn"] = CombinedLoss(
+                    station_cdist,
+                    sinkhorn_every=SINKHORN_EVERY,
+                    sinkhorn_fraction=SINKHORN_FRACTION,
+                    dtype=loss_dtype,
+                )
+            elif args.x_loss_function == "exact_emd":
+                training_kwargs["loss_fn"] = ExactEMDLoss(
+                    station_cdist, dtype=loss_dtype
+                )
+            else:
+                raise NotImplementedError(
+                    "Must be sinhorn, combined_sinkhorn, multiscale_sinkhorn,"
+                    " convolutional_sinkhorn or exact_emd"
+                )
     elif args.x_loss_function == "distribution":
-        training_kwargs["loss_fn"] = DistributionMSE()
+        training_kwargs["loss_fn"] = DistributionMSE(dtype=loss_dtype)
     elif args.x_loss_function == "crossentropy":
-        training_kwargs["loss_fn"] = StepwiseCrossentropy()
+        training_kwargs["loss_fn"] = StepwiseCrossentropy(dtype=loss_dtype)
 
     # Run model comparison
     test_models(
@@ -266,6 +332,8 @@ if __name__ == "__main__":
         max_to_norm=demand_max,
         **training_kwargs,
     )
+    if hasattr(training_kwargs.get("loss_fn"), "timing_report"):
+        print(training_kwargs["loss_fn"].timing_report())
 
     if args.y_clustermethod is not None:
         # save the station hierarchy
@@ -1,5 +1,7 @@
 import numpy as np
 
+from geoemd.hierarchy.tree_index import TreeIndex
+
 
 def test_hierarchy(hier, demand_agg, station_groups, stations_locations):
     example_group = "Group_28"
@@ -17,16 +19,10 @@ def test_hierarchy(hier, demand_agg, station_groups, stations_locations):
             - station_groups.loc[child_2, ["x", "y"]].values
         ),
     )
-    collect_stations = []
-
-    def get_children(group):
-        if "Group" not in group:
-            collect_stations.append(group)
-        else:
-            for child in hier[group]:
-                get_children(child)
-
-    get_children(example_group)
+    tree = TreeIndex.from_hier(hier)
+    collect_stations = tree.names[
+        tree.leaves(tree.get_index([example_group])[0])
+    ].tolist()
     print("GET CHILDREN", collect_stations)
 
     # assert coordinates are correct
@@ -37,3 +33,119 @@ def test_hierarchy(hier, demand_agg, station_groups, stations_locations):
         .values,
         0,
     )
+
+
+def test_batched_emd():
+    import pandas as pd
+    from geoemd.emd_eval import EMDWrapper
+
+    rng = np.random.default_rng(0)
+    stations = pd.DataFrame(
+        rng.uniform(size=(20, 2)), columns=["x", "y"], index=np.arange(20)
+    )
+    stations.index.name = "station_id"
+    samples, steps, station_ids = np.meshgrid(
+        np.arange(4), np.arange(3), stations.index, indexing="ij"
+    )
+    res = pd.DataFrame(
+        {
+            "group": station_ids.flatten(),
+            "steps_ahead": steps.flatten(),
+            "val_sample_ind": samples.flatten(),
+            "pred": rng.uniform(size=samples.size),
+            "gt": rng.uniform(size=samples.size),
+        }
+    )
+    emd_compute = EMDWrapper(stations, res.drop("pred", axis=1))
+    res["pred_emd"] = res["pred"]
+    res["station"] = res["group"]
+    assert np.allclose(
+        emd_compute.compute_emd(res), emd_compute.compute_emd_groupwise(res)
+    )
+
+
+def test_emd_potentials():
+    from scipy.spatial.distance import cdist
+    from geoemd.loss.emd_loss import _solve_item
+
+    rng = np.random.default_rng(0)
+    cost = cdist(rng.uniform(size=(8, 2)), rng.uniform(size=(6, 2)))
+    a = rng.uniform(size=8)
+    a = a / np.sum(a)
+    b = rng.uniform(size=6)
+    b = b / np.sum(b)
+    emd, f, g = _solve_item(a, b, cost)
+    # strong duality and feasibility of the potentials
+    assert np.isclose(emd, np.dot(a, f) + np.dot(b, g))
+    assert np.all(f[:, None] + g[None] <= cost + 1e-9)
+
+
+def test_warm_start_sinkhorn():
+    import torch
+    from scipy.spatial.distance import cdist
+    from geoemd.loss.sinkhorn_loss import SinkhornLoss, normalize_pred_gt
+
+    rng = np.random.default_rng(0)
+    coords = rng.uniform(size=(15, 2))
+    cost = cdist(coords, coords) / np.sqrt(2)
+    a, b = normalize_pred_gt(
+        torch.from_numpy(rng.normal(size=(4, 15))),
+        torch.from_numpy(rng.uniform(size=(4, 15))),
+    )
+    other_a, other_b = normalize_pred_gt(
+        torch.from_numpy(rng.normal(size=(4, 15))),
+        torch.from_numpy(rng.uniform(size=(4, 15))),
+    )
+    loss = SinkhornLoss(
+        cost,
+        normalize_c=False,
+        blur=0.1,
+        warm_start=True,
+        tol=1e-6,
+        dtype=torch.float64,
+    )
+    cold = loss.solve(a, b)
+    # warm start from the potentials of another problem
+    loss.solve(other_a, other_b)
+    warm = loss.solve(a, b)
+    assert np.allclose(warm.numpy(), cold.numpy(), rtol=1e-4)
+    assert np.all(loss.n_iters.numpy() < loss.max_iter)
+
+
+def test_transform_demand_hierarchy():
+    import pandas as pd
+    import pytest
+    from geoemd.hierarchy.clustering_hierarchy import SpatialClustering
+
+    rng = np.random.default_rng(0)
+    stations = pd.DataFrame(
+        rng.uniform(size=(12, 2)), columns=["x", "y"], index=np.arange(12)
+    )
+    stations.index.name = "station_id"
+    demand = pd.DataFrame(
+        rng.integers(0, 5, size=(6, 12)), columns=stations.index
+    )
+    clustering = SpatialClustering(stations)
+    clustering(n_clusters=3)
+    demand_agg = clustering.transform_demand(demand, hierarchy=True)
+    # stations, then clusters, then the total
+    assert list(demand_agg.columns[:12]) == list(demand.columns)
+    groups = ["Group_0", "Group_1", "Group_2"]
+    assert list(demand_agg.columns[12:]) == groups + ["total"]
+    assert np.all(demand_agg["total"] == demand.sum(axis=1))
+    assert np.all(demand_agg[groups].sum(axis=1) == demand.sum(axis=1))
+    # station ids of another type are not silently dropped
+    with pytest.raises(ValueError):
+        clustering.transform_demand(demand.rename(columns=str))
+
+
+def test_tree_index():
+    hier = {"total": ["A", "B"], "A": ["1", "2"], "B": ["C", "3"], "C": ["4"]}
+    tree = TreeIndex.from_hier(hier)
+    root = tree.get_index(["total"])[0]
+    assert sorted(tree.names[tree.leaves(root)]) == ["1", "2", "3", "4"]
+    assert sorted(tree.names[tree.nodes_at_depth(2)]) == ["1", "2", "3", "C"]
+    # leaves that are reached before are part of the frontier
+    assert sorted(tree.names[tree.frontier(root, 3)]) == ["1", "2", "3", "4"]
+    b_node = tree.get_index(["B"])[0]
+    assert sorted(tree.names[tree.frontier(b_node, 1)]) == ["3", "C"]